@@ -9,24 +9,48 @@ from sklearn.feature_extraction.text import CountVectorizer
 from nltk.corpus import stopwords
 import nltk.stem
 import os
+import multiprocessing
+import json
+import hashlib
+import shutil
 import dataset.synthetic_doc as syn_doc
 import copy
 import operator
 from audioop import reverse
 
+CORPUS_CACHE_VERSION = 1
+#real_data configurations that change the processed corpus
+CORPUS_CACHE_CONFIGS = ["max_features", "lemmatize", "min_tf", "max_w_percent",\
+                        "max_dispersion", "filter_words_flag",\
+                        "remove_from_stop_words", "add_to_stop_words"]
+
 #add_to_stop_words = ["object", "time", "zero"]
 #add_to_stop_words = ["object", "time", "want", "one", "velocity", "would"]
 #add_to_stop_words = ["object", "time", "want", "one", "velocity", "would", "positive", "negative"] -config for 3 seg experiment k = 2
 class Document(object):
     def __init__(self, doc_path, configs):
+        rho, sents = self.process_doc(doc_path)
+        self.load_corpus(rho, sents, configs)
+        
+    def set_word_filter_configs(self, configs):
+        '''
+        Sets the stop word lists and the number of tokenization
+        processes, both when the corpus is processed and when
+        it is loaded from the cache.
+        '''
+        self.remove_from_stop_words = configs["real_data"]["remove_from_stop_words"]
+        self.add_to_stop_words = configs["real_data"]["add_to_stop_words"]
+        #Number of processes used to tokenize the documents
+        self.n_jobs = configs["real_data"]["n_jobs"] if "n_jobs" in configs["real_data"] else 1
+        
+    def load_corpus(self, rho, sents, configs):
         max_features = configs["real_data"]["max_features"]
         lemmatize = eval(configs["real_data"]["lemmatize"])
         min_tf = configs["real_data"]["min_tf"]
         max_w_percent = configs["real_data"]["max_w_percent"]
         max_dispersion = configs["real_data"]["max_dispersion"]
         filter_words_flag = eval(configs["real_data"]["filter_words_flag"])
-        self.remove_from_stop_words = configs["real_data"]["remove_from_stop_words"]
-        self.add_to_stop_words = configs["real_data"]["add_to_stop_words"]
+        self.set_word_filter_configs(configs)
         
         self.isMD = False
         self.K = 2
@@ -36,94 +60,93 @@ class Document(object):
         self.U_I_topics = sparse.csr_matrix((1, 1), dtype=int32)
         self.W_K_counts = sparse.csr_matrix((1, 1), dtype=int32)
         
-        self.my_stopwords = self.load_sw(doc_path, lemmatize, min_tf)
-        self.load_doc(doc_path, max_features, lemmatize)
+        self.my_stopwords = self.load_sw(sents, lemmatize, min_tf)
+        self.load_doc(rho, sents, max_features, lemmatize)
         
         if filter_words_flag:    
-            self.filter_words(max_w_percent, max_dispersion)
-            #Talking about ineficiency...
+            w_to_filter = self.filter_words(max_w_percent, max_dispersion)
             '''
-            filter_words adds to the global variables to_stop_words.
-            Basically I have to reload the corpus all over again with the
-            new list of stopwords.
-            
-            The thing is that to calculate the words to be filtered I need
-            the matrixes obtained by loading the corpus.
+            To calculate the words to be filtered I need the matrixes
+            obtained by loading the corpus. Instead of reloading the
+            corpus with the new stopwords, the filtered words are
+            removed from the matrixes already built.
             '''
-            self.load_doc(doc_path, max_features, lemmatize, min_tf)
+            self.remove_words(w_to_filter)
         self.del_ghost_lines() 
     
     def process_doc(self, doc_path):
-        rho = []
-        sents = []
         with open(doc_path) as doc_file:
             lins = doc_file.readlines()[1:-1]
-            for lin in lins:
-                if lin == "==========\n":
-                    rho[-1] = 1
-                else:
-                    rho.append(0)
-                    sents.append(lin)
+        return self.process_lines(lins)
+    
+    def process_lines(self, lins):
+        rho = []
+        sents = []
+        for lin in lins:
+            if lin == "==========\n":
+                rho[-1] = 1
+            else:
+                rho.append(0)
+                sents.append(lin)
         return rho, sents
                        
-    def load_doc(self, doc_path, max_features, lemmatize):
-        self.rho, sents = self.process_doc(doc_path)
+    def load_doc(self, rho, sents, max_features, lemmatize):
+        self.rho = rho
         self.n_sents = len(sents)
         self.rho_eq_1 = np.append(np.nonzero(self.rho)[0], [self.n_sents-1])
         self.n_segs = len(self.rho_eq_1)
         
-        if lemmatize:
-            vectorizer = ENLemmatizerCountVectorizer(self.my_stopwords, max_features=max_features)
+        '''
+        The sentences are tokenized only once with the analyzer of the vectorizer.
+        The tokens are then counted by a CountVectorizer that uses them as they
+        are, which gives the same vocabulary and counts as fitting the sentences.
+        '''
+        if self.n_jobs > 1 and len(self.docs_index) > 1:
+            #Each document is tokenized (and lemmatized) by a worker process
+            docs_sents = []
+            doc_begin = 0
+            for doc_end in self.docs_index:
+                docs_sents.append(sents[doc_begin:doc_end])
+                doc_begin = doc_end
+            with multiprocessing.Pool(self.n_jobs, initializer=init_tokenizer, initargs=(self.my_stopwords, lemmatize)) as pool:
+                docs_tokens = pool.map(tokenize_sents, docs_sents)
+            sents_tokens = [u_tokens for doc_tokens in docs_tokens for u_tokens in doc_tokens]
         else:
-            vectorizer = CountVectorizer(analyzer = "word",\
-                                         strip_accents = "unicode",\
-                                         stop_words = self.my_stopwords,\
-                                         max_features=max_features)
-            
-        self.U_W_counts = vectorizer.fit_transform(sents).toarray()
-        self.vocab = vectorizer.vocabulary_
+            analyzer = build_vectorizer(self.my_stopwords, lemmatize).build_analyzer()
+            sents_tokens = [analyzer(u) for u in sents]
+        token_vectorizer = CountVectorizer(analyzer=tokens_analyzer, max_features=max_features)
+        self.U_W_counts = token_vectorizer.fit_transform(sents_tokens).tocsr()
+        self.vocab = token_vectorizer.vocabulary_
         self.inv_vocab =  {v: k for k, v in self.vocab.items()}
         self.W = len(self.vocab)
-        self.sents_len = np.sum(self.U_W_counts, axis = 1)
+        
+        #Flat token ids, tokens discarded by the vectorizer (max_features) have id -1
+        n_tokens = np.array([len(u_tokens) for u_tokens in sents_tokens], dtype=np.int64)
+        token_ids = np.array([self.vocab.get(w_ui, -1) for u_tokens in sents_tokens for w_ui in u_tokens], dtype=np.int64)
+        token_sents = np.repeat(np.arange(self.n_sents), n_tokens)
+        in_vocab = token_ids >= 0
+        self.W_I_words = token_ids[in_vocab]
+        wi_sents = token_sents[in_vocab] #Sentence of each word in W_I_words
+        self.sents_len = np.bincount(wi_sents, minlength=self.n_sents)
+        sents_wi_begin = np.append([0], np.cumsum(self.sents_len)) #CSR-style offsets of the sentences in W_I_words
+        
         self.U_I_words = np.zeros((self.n_sents, max(self.sents_len)), dtype=int32)
-        self.W_I_words = []
-        self.d_u_wi_indexes = []
-        '''
-        This part is not efficient, but I have figure out a way to use CountVectorizer
-        and obtain the word sequence that I need for the U_I_words variable.
+        self.U_I_words[wi_sents, np.arange(len(self.W_I_words))-sents_wi_begin[wi_sents]] = self.W_I_words
         
-        I am assuming that by using build_analyzer I obtain the same
-        preprocessing used in CountVectorizer. Then, filtering by vocab
-        indicates which words were discarded.
-        '''
-        analyzer = vectorizer.build_analyzer()
-        word_count = 0
-        doc_i_u = []
-        for u_index, u in enumerate(sents):
-            u_w_indexes = []
-            u_I = analyzer(u)
-            i = 0
-            for w_ui in u_I:
-                if w_ui in self.vocab:
-                    u_w_indexes.append(word_count)
-                    word_count += 1
-                    vocab_index = self.vocab[w_ui]
-                    self.U_I_words[u_index, i] = vocab_index
-                    self.W_I_words.append(vocab_index)
-                    i += 1
-                    
-            if len(u_w_indexes) > 0:
-                doc_i_u.append(u_w_indexes)
-            if u_index+1 in self.docs_index:
-                self.d_u_wi_indexes.append(doc_i_u)
-                doc_i_u = []
-        self.W_I_words = np.array(self.W_I_words)
+        self.d_u_wi_indexes = []
+        doc_begin = 0
+        for doc_end in self.docs_index:
+            doc_i_u = []
+            for u in range(doc_begin, doc_end):
+                if self.sents_len[u] > 0:
+                    doc_i_u.append(list(range(sents_wi_begin[u], sents_wi_begin[u+1])))
+            self.d_u_wi_indexes.append(doc_i_u)
+            doc_begin = doc_end
                         
-    def load_sw(self, doc_path, lemmatize, min_tf):
+    def load_sw(self, sents, lemmatize, min_tf):
         sw_list = stopwords.words("english")
         sw_list += self.add_to_stop_words
         
-        rho, sents = self.process_doc(doc_path)
         #It seems that lemmatization takes place after sw removal
         #we need to specify sw in the unlematized form
         vectorizer = CountVectorizer(analyzer = "word",\
@@ -178,6 +201,49 @@ class Document(object):
             if n_w_percent > max_w_percent:
                 w_to_filter.append(w_str)
         self.add_to_stop_words += w_to_filter
+        return w_to_filter
+    
+    def remove_words(self, words):
+        '''
+        Removes words from the vocabulary. The columns of the count
+        matrix are masked and the vocabulary indexes of the remaining
+        words are remapped in U_I_words, W_I_words and d_u_wi_indexes.
+        :param words: list of words (strings) to remove
+        '''
+        keep_w = np.ones(self.W, dtype=bool)
+        for w_str in words:
+            keep_w[self.vocab[w_str]] = False
+        if np.all(keep_w):
+            return
+        w_map = np.cumsum(keep_w)-1 #New vocabulary index of each word
+        w_map[~keep_w] = -1
+        
+        self.U_W_counts = self.U_W_counts[:, np.nonzero(keep_w)[0]]
+        self.vocab = {w_str: int(w_map[w]) for w_str, w in self.vocab.items() if keep_w[w]}
+        self.inv_vocab =  {v: k for k, v in self.vocab.items()}
+        self.W = len(self.vocab)
+        
+        #U_I_words is padded with zeros, only the first sents_len positions of each row are words
+        U_I_words = w_map[self.U_I_words]
+        keep_ui = (np.arange(self.U_I_words.shape[1]) < self.sents_len[:, None]) & (U_I_words >= 0)
+        self.sents_len = np.asarray(self.U_W_counts.sum(axis=1)).ravel()
+        new_i = np.cumsum(keep_ui, axis=1)-1
+        rows = np.nonzero(keep_ui)[0]
+        self.U_I_words = np.zeros((self.n_sents, max(self.sents_len)), dtype=int32)
+        self.U_I_words[rows, new_i[keep_ui]] = U_I_words[keep_ui]
+        
+        keep_wi = keep_w[self.W_I_words]
+        wi_map = np.cumsum(keep_wi)-1 #New index of each word in W_I_words
+        self.W_I_words = w_map[self.W_I_words[keep_wi]]
+        d_u_wi_indexes = []
+        for doc_i_u in self.d_u_wi_indexes:
+            new_doc_i_u = []
+            for u in doc_i_u:
+                new_u = [int(wi_map[wi]) for wi in u if keep_wi[wi]]
+                if len(new_u) > 0:
+                    new_doc_i_u.append(new_u)
+            d_u_wi_indexes.append(new_doc_i_u)
+        self.d_u_wi_indexes = d_u_wi_indexes
             
     '''
     Boundary ghost lines are lines with all word counts equal to 0.
@@ -185,7 +251,7 @@ class Document(object):
     I print a warning if I find them.
     '''                    
     def del_ghost_lines(self):
-        self.ghost_lines = np.where(~self.U_W_counts.any(axis=1))[0]
+        self.ghost_lines = np.where(self.sents_len == 0)[0]
         boundary_ghost_lines = np.intersect1d(self.rho_eq_1, self.ghost_lines)
         if len(boundary_ghost_lines) > 0:
             print("WARNING: the following ghost lines match a boundary: %s" % (str(boundary_ghost_lines)))
@@ -203,34 +269,159 @@ class Document(object):
                     
         
         self.n_sents -= len(self.ghost_lines)
-        self.U_W_counts = np.delete(self.U_W_counts, self.ghost_lines, axis=0)
+        self.U_W_counts = self.U_W_counts[np.nonzero(self.sents_len)[0]]
         self.U_I_words = np.delete(self.U_I_words, self.ghost_lines, axis=0)
         self.rho = np.delete(self.rho, self.ghost_lines, axis=0)
         self.rho_eq_1 = np.append(np.nonzero(self.rho)[0], [self.n_sents-1])
         self.n_segs = len(self.rho_eq_1)
-        self.sents_len = np.sum(self.U_W_counts, axis = 1)
+        self.sents_len = np.asarray(self.U_W_counts.sum(axis=1)).ravel()
         
 class MultiDocument(Document):
     def __init__(self, configs):
         self.doc_names = []
         self.docs_index =[]
-        i = 0
-        doc_path = "tmp_docs0.txt"
-        while os.path.isfile(doc_path):
-            i += 1
-            doc_path = "tmp_docs"+str(i)+".txt"
-        
-        self.prepare_multi_doc(configs["real_data"]["docs_dir"], doc_path)
-        Document.__init__(self, doc_path, configs)
-        self.update_doc_index()
-        os.remove(doc_path)
+        cache_path = None
+        if "cache_dir" in configs["real_data"]:
+            cache_path = os.path.join(configs["real_data"]["cache_dir"], self.corpus_cache_key(configs))
+        
+        if cache_path is not None and os.path.isfile(os.path.join(cache_path, "meta.json")):
+            self.load_corpus_cache(cache_path)
+            self.set_word_filter_configs(configs)
+        else:
+            rho, sents = self.prepare_multi_doc(configs["real_data"]["docs_dir"])
+            self.load_corpus(rho, sents, configs)
+            self.update_doc_index()
+            self.seg_dur_prior_indv = self.get_prior_indv()
+            self.seg_dur_prior_dataset = self.get_prior_dataset()
+            self.seg_dur_prior_modality = self.get_prior_modality()
+            if cache_path is not None:
+                self.save_corpus_cache(cache_path)
         self.isMD = True
-        self.doc_topic_seq, self.doc_rho_topics, self.max_topics = self.load_doc_topic_seq(configs["real_data"]["doc_links_dir"])
-        self.seg_dur_prior_indv = self.get_prior_indv()
-        self.seg_dur_prior_dataset = self.get_prior_dataset()
-        self.seg_dur_prior_modality = self.get_prior_modality()
+        links_index_path = None
+        if "cache_dir" in configs["real_data"]:
+            links_dir_hash = hashlib.sha1(os.path.abspath(configs["real_data"]["doc_links_dir"]).encode("utf-8")).hexdigest()
+            links_index_path = os.path.join(configs["real_data"]["cache_dir"], "links_"+links_dir_hash+".json")
+        self.doc_topic_seq, self.doc_rho_topics, self.max_topics = self.load_doc_topic_seq(configs["real_data"]["doc_links_dir"], links_index_path)
         self.print_processed_docs(configs["real_data"]["docs_processed_dir"])
         
+    def corpus_cache_key(self, configs):
+        '''
+        Returns the hash of the document contents and of the
+        real_data configurations used to process them.
+        :param configs: configuration dictionary
+        '''
+        doc_dir = configs["real_data"]["docs_dir"]
+        key_configs = {}
+        for config_key in CORPUS_CACHE_CONFIGS:
+            key_configs[config_key] = configs["real_data"][config_key]
+        h = hashlib.sha1()
+        h.update(json.dumps([CORPUS_CACHE_VERSION, key_configs], sort_keys=True).encode("utf-8"))
+        for doc in sorted(os.listdir(doc_dir)):
+            h.update(doc.encode("utf-8"))
+            with open(os.path.join(doc_dir, doc), "rb") as f:
+                h.update(hashlib.sha1(f.read()).digest())
+        return h.hexdigest()
+    
+    def save_corpus_cache(self, cache_path):
+        '''
+        Stores the processed corpus in cache_path. Arrays are saved
+        as .npy files and the remaining attributes in meta.json.
+        The cache is written to a temporary directory first so that
+        concurrent runs never read an incomplete cache.
+        :param cache_path: directory of the cache entry
+        '''
+        tmp_path = cache_path+".tmp"+str(os.getpid())
+        os.makedirs(tmp_path)
+        U_W_counts = sparse.csr_matrix(self.U_W_counts, copy=True)
+        U_W_counts.sum_duplicates() #Memory-mapped arrays are read-only, they must be stored in canonical format
+        u_offsets = [0]
+        doc_offsets = [0]
+        for doc_i_u in self.d_u_wi_indexes:
+            for u in doc_i_u:
+                u_offsets.append(u_offsets[-1]+len(u))
+            doc_offsets.append(len(u_offsets)-1)
+        d_u_wi_flat = [wi for doc_i_u in self.d_u_wi_indexes for u in doc_i_u for wi in u]
+        arrays = {"U_W_counts_data": U_W_counts.data,
+                  "U_W_counts_indices": U_W_counts.indices,
+                  "U_W_counts_indptr": U_W_counts.indptr,
+                  "U_I_words": self.U_I_words,
+                  "W_I_words": self.W_I_words,
+                  "rho": self.rho,
+                  "sents_len": self.sents_len,
+                  "ghost_lines": self.ghost_lines,
+                  "d_u_wi_flat": np.array(d_u_wi_flat, dtype=np.int64),
+                  "d_u_wi_u_offsets": np.array(u_offsets, dtype=np.int64),
+                  "d_u_wi_doc_offsets": np.array(doc_offsets, dtype=np.int64)}
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, name+".npy"), np.asarray(array))
+        meta = {"doc_names": self.doc_names,
+                "docs_index": [int(doc_index) for doc_index in self.docs_index],
+                "n_docs": self.n_docs,
+                "n_sents": int(self.n_sents),
+                "vocab": {w: int(w_index) for w, w_index in self.vocab.items()},
+                "my_stopwords": self.my_stopwords,
+                "seg_dur_prior_indv": np.asarray(self.seg_dur_prior_indv).tolist(),
+                "seg_dur_prior_dataset": np.asarray(self.seg_dur_prior_dataset).tolist(),
+                "seg_dur_prior_modality": np.asarray(self.seg_dur_prior_modality).tolist()}
+        with open(os.path.join(tmp_path, "meta.json"), "w+") as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, cache_path)
+        except OSError:
+            #Another run already stored the same corpus
+            shutil.rmtree(tmp_path, ignore_errors=True)
+    
+    def load_corpus_cache(self, cache_path):
+        '''
+        Loads the processed corpus stored by save_corpus_cache.
+        The larger arrays are memory-mapped.
+        :param cache_path: directory of the cache entry
+        '''
+        def load_array(name, mmap_mode="r"):
+            return np.load(os.path.join(cache_path, name+".npy"), mmap_mode=mmap_mode)
+        
+        with open(os.path.join(cache_path, "meta.json")) as f:
+            meta = json.load(f)
+        self.doc_names = meta["doc_names"]
+        self.docs_index = meta["docs_index"]
+        self.n_docs = meta["n_docs"]
+        self.n_sents = meta["n_sents"]
+        self.vocab = meta["vocab"]
+        self.inv_vocab =  {v: k for k, v in self.vocab.items()}
+        self.W = len(self.vocab)
+        self.my_stopwords = meta["my_stopwords"]
+        self.seg_dur_prior_indv = meta["seg_dur_prior_indv"]
+        self.seg_dur_prior_dataset = meta["seg_dur_prior_dataset"]
+        self.seg_dur_prior_modality = meta["seg_dur_prior_modality"]
+        
+        self.isMD = False
+        self.K = 2
+        self.U_K_counts = sparse.csr_matrix((1, 1), dtype=int32)
+        self.U_I_topics = sparse.csr_matrix((1, 1), dtype=int32)
+        self.W_K_counts = sparse.csr_matrix((1, 1), dtype=int32)
+        
+        self.U_W_counts = sparse.csr_matrix((load_array("U_W_counts_data"),\
+                                             load_array("U_W_counts_indices"),\
+                                             load_array("U_W_counts_indptr")),\
+                                             shape=(self.n_sents, self.W))
+        self.U_I_words = load_array("U_I_words")
+        self.W_I_words = load_array("W_I_words")
+        self.rho = load_array("rho", mmap_mode=None)
+        self.sents_len = load_array("sents_len", mmap_mode=None)
+        self.ghost_lines = load_array("ghost_lines", mmap_mode=None)
+        self.rho_eq_1 = np.append(np.nonzero(self.rho)[0], [self.n_sents-1])
+        self.n_segs = len(self.rho_eq_1)
+        
+        d_u_wi_flat = load_array("d_u_wi_flat").tolist()
+        u_offsets = load_array("d_u_wi_u_offsets", mmap_mode=None)
+        doc_offsets = load_array("d_u_wi_doc_offsets", mmap_mode=None)
+        self.d_u_wi_indexes = []
+        for doc_i in range(len(doc_offsets)-1):
+            doc_i_u = []
+            for u in range(doc_offsets[doc_i], doc_offsets[doc_i+1]):
+                doc_i_u.append(d_u_wi_flat[u_offsets[u]:u_offsets[u+1]])
+            self.d_u_wi_indexes.append(doc_i_u)
+        
     def print_processed_docs(self, out_dir):
         u_i = 0
         for doc_i, doc_name in enumerate(self.doc_names):
@@ -331,11 +522,59 @@ class MultiDocument(Document):
         for doc_name, count in sorted_docs:
             print("%s %s" % (doc_name, count))
         
-    def load_doc_topic_seq(self, links_dir):
-        topic_dict = {}
+    def build_links_index(self, links_dir):
+        '''
+        Returns an index mapping the name of each document (the part of
+        the link file name before "_seg") to a dictionary with the topic
+        of each of its segments. Topic ids follow the order of the topic
+        directories in links_dir.
+        :param links_dir: directory with a subdirectory per topic
+        '''
+        links_index = {}
+        for k, dir_name in enumerate(os.listdir(links_dir)):
+            for doc_seg in os.listdir(links_dir+"/"+dir_name):
+                if "_seg" not in doc_seg:
+                    continue
+                doc_seg_split = doc_seg.split("_seg")
+                i = int(doc_seg_split[1].split(".txt")[0])
+                if doc_seg_split[0] not in links_index:
+                    links_index[doc_seg_split[0]] = {}
+                links_index[doc_seg_split[0]][i] = k
+        return links_index
+    
+    def load_links_index(self, links_dir, links_index_path):
+        '''
+        Returns the output of build_links_index, using the copy stored
+        in links_index_path if no topic directory changed since it was stored.
+        :param links_dir: directory with a subdirectory per topic
+        :param links_index_path: json file with the stored index (None to disable)
+        '''
+        if links_index_path is None:
+            return self.build_links_index(links_dir)
+        
+        dirs_mtime = {"": os.path.getmtime(links_dir)}
+        for dir_name in os.listdir(links_dir):
+            dirs_mtime[dir_name] = os.path.getmtime(links_dir+"/"+dir_name)
+        if os.path.isfile(links_index_path):
+            with open(links_index_path) as f:
+                links_cache = json.load(f)
+            if links_cache["dirs_mtime"] == dirs_mtime:
+                links_index = {}
+                for doc_name, topic_seq_dict in links_cache["links_index"].items():
+                    links_index[doc_name] = {int(i): k for i, k in topic_seq_dict.items()}
+                return links_index
+            
+        links_index = self.build_links_index(links_dir)
+        os.makedirs(os.path.dirname(links_index_path), exist_ok=True)
+        tmp_path = links_index_path+".tmp"+str(os.getpid())
+        with open(tmp_path, "w+") as f:
+            json.dump({"dirs_mtime": dirs_mtime, "links_index": links_index}, f)
+        os.replace(tmp_path, links_index_path)
+        return links_index
+        
+    def load_doc_topic_seq(self, links_dir, links_index_path=None):
         docs_topic_seq = []
-        for i, dir_name in enumerate(os.listdir(links_dir)):
-            topic_dict[dir_name] = i
+        links_index = self.load_links_index(links_dir, links_index_path)
             
         for doc_name in self.doc_names:
             if "processed" in doc_name:
@@ -344,12 +583,14 @@ class MultiDocument(Document):
             else:
                 doc_name = doc_name[:-4]
             topic_seq = []
-            topic_seq_dict = {}
-            for dir_name in os.listdir(links_dir):
-                for doc_seg in os.listdir(links_dir+"/"+dir_name):
-                    if doc_name in doc_seg:
-                        i = int(doc_seg.split("_seg")[1].split(".txt")[0])
-                        topic_seq_dict[i] = topic_dict[dir_name]
+            if doc_name in links_index:
+                topic_seq_dict = links_index[doc_name]
+            else:
+                #Link files are matched by substring (e.g. the prefix of processed documents)
+                topic_seq_dict = {}
+                for doc_seg_name in links_index:
+                    if doc_name in doc_seg_name+"_seg":
+                        topic_seq_dict.update(links_index[doc_seg_name])
             for i in range(1, len(topic_seq_dict.keys())+1):
                 topic_seq.append(topic_seq_dict[i])
             docs_topic_seq.append(topic_seq)
@@ -377,8 +618,14 @@ class MultiDocument(Document):
         
         return docs_topic_seq, doc_rho_topics, max_topics
     
-    def prepare_multi_doc(self, doc_dir, doc_tmp_path):
-        str_cat_files = ""
+    def prepare_multi_doc(self, doc_dir):
+        '''
+        Reads the documents in doc_dir and returns the rho and sentences
+        of the collection. Documents are streamed line by line, as if they
+        were concatenated into a single document, without writing
+        them to a temporary file.
+        :param doc_dir: directory with the documents
+        '''
         doc_offset = 0
         '''
         docs_file_names = os.listdir(doc_dir)
@@ -393,18 +640,21 @@ class MultiDocument(Document):
         '''
         docs_file_names = os.listdir(doc_dir)
         docs_file_names = sorted(docs_file_names)
+        lins = []
+        lin_carry = "" #Last line of the previous document, which continues in the next one
         for doc in docs_file_names:
             self.doc_names.append(doc)
             with open(os.path.join(doc_dir, doc), encoding="utf-8", errors='ignore') as f:
                 str_doc = f.read()
-                str_cat_files += str_doc[:-10]
+                doc_lins = (lin_carry+str_doc[:-10]).split("\n")
+                lin_carry = doc_lins.pop()
+                lins += [lin+"\n" for lin in doc_lins]
                 doc_len = (str_doc.count("\n")+1) - str_doc.count("==========")
                 doc_offset += doc_len
                 self.docs_index.append(doc_offset)
         self.n_docs = len(self.docs_index)
-        str_cat_files += "=========="
-        with open(doc_tmp_path, "w+") as f_out:
-            f_out.write(str_cat_files)
+        lins.append(lin_carry+"==========")
+        return self.process_lines(lins[1:-1])
     
     #TODO: REALLY CHECK THIS IS CORRECT
     def update_doc_index(self):
@@ -427,6 +677,35 @@ class MultiDocument(Document):
         indv_docs = syn_doc.multi_doc_slicer(self)
         return indv_docs
                         
+def tokens_analyzer(tokens):
+    '''
+    Analyzer for CountVectorizer when the documents are already tokenized.
+    '''
+    return tokens
+
+def build_vectorizer(stopwords_list, lemmatize, max_features=None):
+    if lemmatize:
+        return ENLemmatizerCountVectorizer(stopwords_list, max_features=max_features)
+    else:
+        return CountVectorizer(analyzer = "word",\
+                               strip_accents = "unicode",\
+                               stop_words = stopwords_list,\
+                               max_features=max_features)
+
+#Analyzer of the tokenizer worker processes
+GL_ANALYZER = None
+
+def init_tokenizer(stopwords_list, lemmatize):
+    '''
+    Initializes a tokenizer worker process. The analyzer (and its
+    lemma cache) is shared by all documents the worker tokenizes.
+    '''
+    global GL_ANALYZER
+    GL_ANALYZER = build_vectorizer(stopwords_list, lemmatize).build_analyzer()
+    
+def tokenize_sents(sents):
+    return [GL_ANALYZER(u) for u in sents]
+    
 class ENLemmatizerCountVectorizer(CountVectorizer):
     def __init__(self, stopwords_list=None, max_features=None):
         CountVectorizer.__init__(self,analyzer="word",\
@@ -437,4 +716,9 @@ class ENLemmatizerCountVectorizer(CountVectorizer):
         
     def build_analyzer(self):
         analyzer = super(ENLemmatizerCountVectorizer, self).build_analyzer()
-        return lambda doc: ([self.en_lemmatizer.lemmatize(w) for w in analyzer(doc)])
\ No newline at end of file
+        lemma_cache = {} #Words repeat a lot, WordNetLemmatizer is only called once per word
+        def lemmatize(w):
+            if w not in lemma_cache:
+                lemma_cache[w] = self.en_lemmatizer.lemmatize(w)
+            return lemma_cache[w]
+        return lambda doc: ([lemmatize(w) for w in analyzer(doc)])
\ No newline at end of file
@@ -4,6 +4,7 @@ Created on Feb 22, 2018
 @author: pjdrm
 '''
 from model.dp.segmentor import AbstractSegmentor, SentenceCluster
+from model.model_tools import Beam
 from itertools import chain, combinations
 import copy
 import numpy as np
@@ -142,7 +143,7 @@ class MultiDocDPSeg(AbstractSegmentor):
         :param u_begin: language model index
         '''
         if u_begin == 0:#The first column corresponds to having all sentences from all docs in a single segment (there is only one language model)
-            u_cluster = SentenceCluster(u_begin, u_end, list(range(self.data.n_docs)), self.data, 0)
+            u_cluster = SentenceCluster(u_begin, u_end, list(range(self.data.n_docs)), 0)
             segmentation_ll = self.segment_ll(u_cluster.get_word_counts())
             return segmentation_ll, [u_cluster]
         
@@ -239,22 +240,9 @@ class MultiDocDPSeg(AbstractSegmentor):
                         seg_ll = self.segmentation_ll(best_seg)[0]
                         current_best_u_clusters.append((seg_ll, best_seg))
                         
-                current_best_u_clusters = sorted(current_best_u_clusters, key=operator.itemgetter(0), reverse=True)
-                cached_segs = []
-                for seg_result in current_best_u_clusters:
-                    seg_ll = seg_result[0]
-                    seg_clusters = seg_result[1]
-                    
-                    is_cached = self.is_cached_seg(seg_ll, cached_segs)
-                    if not is_cached:
-                        if len(cached_segs) < self.max_cache:
-                            cached_segs.append((seg_ll, seg_clusters))
-                            cached_segs = sorted(cached_segs, key=operator.itemgetter(0), reverse=True)
-                            
-                        elif seg_ll > cached_segs[-1][0]:
-                            cached_segs[-1] = (seg_ll, seg_clusters)
-                            cached_segs = sorted(cached_segs, key=operator.itemgetter(0), reverse=True)
-                final_u_clusters = cached_segs
+                beam = Beam(self.max_cache)
+                beam.extend(current_best_u_clusters)
+                final_u_clusters = beam.entries()
             
         return final_u_clusters
     
@@ -268,7 +256,7 @@ class MultiDocDPSeg(AbstractSegmentor):
                 if u_end == 9:
                     a = 0
                 best_u_begin = -1
-                cached_segs = []
+                beam = Beam(self.max_row_cache)
                 for u_begin in range(u_end+1):
                     t.set_description("(%d, %d)" % (u_end, u_begin))
                     if u_begin == 4:
@@ -282,26 +270,16 @@ class MultiDocDPSeg(AbstractSegmentor):
                     for best_seg_i in best_seg:
                         seg_results = self.seg_func(u_begin, u_end, best_seg_i)
                         for seg_result in seg_results:
-                            seg_ll = seg_result[0]
-                            seg_clusters = seg_result[1]
-                            
-                            is_cached = self.is_cached_seg(seg_ll, cached_segs)
-                            if not is_cached:
-                                if len(cached_segs) < self.max_row_cache:
-                                    cached_segs.append((seg_ll, seg_clusters))
-                                    cached_segs = sorted(cached_segs, key=operator.itemgetter(0), reverse=True)
-                                    
-                                elif seg_ll > cached_segs[-1][0]:
-                                    cached_segs[-1] = (seg_ll, seg_clusters)
-                                    cached_segs = sorted(cached_segs, key=operator.itemgetter(0), reverse=True)
+                            beam.push((seg_result[0], seg_result[1]))
                     
-                    f.write("(%d,%d)\tll: %.3f\n"%(u_begin, u_end, cached_segs[0][0]))
+                    best_cached_seg = beam.best()
+                    f.write("(%d,%d)\tll: %.3f\n"%(u_begin, u_end, best_cached_seg[0]))
                     for doc_i in range(self.data.n_docs):
-                        f.write(str(self.get_segmentation(doc_i, cached_segs[0][1]))+" "
-                                +str(self.get_seg_with_topics(doc_i, cached_segs[0][1]))+"\n")
+                        f.write(str(self.get_segmentation(doc_i, best_cached_seg[1]))+" "
+                                +str(self.get_seg_with_topics(doc_i, best_cached_seg[1]))+"\n")
                     f.write("\n")
                 f.write("============\n")
-                self.best_segmentation[u_end] = cached_segs
+                self.best_segmentation[u_end] = beam.entries()
                 #self.print_seg(best_seg_clusters)
             #print("==========================")
             
@@ -3,7 +3,8 @@ Created on Mar 2, 2018
 
 @author: pjdrm
 '''
-from model.dp.segmentor import AbstractSegmentor, SEG_TT
+from model.dp.segmentor import AbstractSegmentor, SegmentationState, SEG_TT, SEG_BL
+from model.model_tools import Beam, SlotBeam
 import numpy as np
 import copy
 import operator
@@ -12,9 +13,9 @@ import toyplot
 import toyplot.pdf
 import shutil
 import os
-import ray
-import itertools
 import multiprocessing
+import tempfile
+import traceback
 from operator import attrgetter
 
 class MultiDocGreedySeg(AbstractSegmentor):
@@ -47,6 +48,9 @@ class MultiDocGreedySeg(AbstractSegmentor):
             self.cache_prune = self.k_slot_cache_prune
             
         self.n_cpus = multiprocessing.cpu_count()
+        self.n_workers = self.n_cpus if "n_workers" not in seg_config else seg_config["n_workers"]
+        self.workers = []
+        self.counts_dir = None
         shutil.rmtree(self.phi_log_dir) if os.path.isdir(self.phi_log_dir) else None
         os.makedirs(self.phi_log_dir)
         
@@ -56,7 +60,7 @@ class MultiDocGreedySeg(AbstractSegmentor):
             phi = cached_seg[2]
             all_phi.append(phi)
         '''
-        phi = cached_segs[0][2]
+        phi = cached_segs[0][2].phi
         
         for t, phi_t in enumerate(phi):
             topic_plot_dict = {}
@@ -125,7 +129,7 @@ class MultiDocGreedySeg(AbstractSegmentor):
         doc_i_segs = []
         for cached_seg in cached_segs:
             cached_u_clusters = cached_seg[1]
-            phi_tt = cached_seg[2]
+            tt_chain = cached_seg[2]
             if b == 23:
                 a = 0
             b += 1
@@ -150,23 +154,139 @@ class MultiDocGreedySeg(AbstractSegmentor):
             #merge_move_clusters = list(set(range(0, self.max_topics))-possible_clusters)
             #test_clusters = test_clusters+merge_move_clusters
             test_clusters = self.check_seg_max_len(test_clusters, doc_i, cached_u_clusters) 
+            if self.seg_func_desc == SEG_BL:
+                #Candidates are only scored here, their segmentations are built in materialize_segs
+                seg_lls, k_cluster_lls, k_log_priors = self.segmentation_ll_bs_batch(cached_u_clusters, u, u, doc_i, test_clusters)
+                for k, seg_ll, k_cluster_ll, k_log_prior in zip(test_clusters, seg_lls, k_cluster_lls, k_log_priors):
+                    doc_i_segs.append((seg_ll, None, None, k, (cached_u_clusters, None, k_cluster_ll, k_log_prior)))
+                continue
+            
             for k in test_clusters:
-                #current_u_clusters = copy.deepcopy(cached_u_clusters)
+                #Only the clusters modified by assign_target_k are copied, the remaining are shared with cached_seg
                 current_u_clusters = copy.copy(cached_u_clusters)
                 current_u_clusters = self.assign_target_k(u, u, doc_i, k, possible_clusters, current_u_clusters)
-                phi_tt = None
+                current_tt_chain = None
                 if self.seg_func_desc == SEG_TT:
-                    seg_ll, phi_tt = self.segmentation_ll(current_u_clusters)
+                    #Only the clusters after the first one modified by assign_target_k are recomputed
+                    seg_ll, current_tt_chain = self.segmentation_ll(current_u_clusters, tt_chain)
                 else:
                     seg_ll = self.segmentation_ll(current_u_clusters)
                 #This was here before but seems wrong, prior is already added in segmentation_ll (even in pre topic tracking version)
                 #if self.use_dur_prior:
                 #    seg_ll += self.segmentation_log_prior(current_u_clusters)
-                doc_i_segs.append((seg_ll, current_u_clusters, phi_tt, k))
+                doc_i_segs.append((seg_ll, current_u_clusters, current_tt_chain, k))
         return doc_i_segs
     
+    def compute_seg_ll_parallel(self, cached_segs, doc_i, u):
+        '''
+        Computes in parallel, with the worker processes, the segmentation likelihood of
+        assigning u to some topic k starting from a segmentation in cached_segs.
+        Each worker only receives its share of cached_segs (in the compact format of
+        SegmentationState.encode) and only returns the scores of the candidates,
+        which are built by materialize_segs.
+        :param cached_segs: u_clusters for which we want to know the likelihood
+        :param doc_i: document index from which u comes
+        :param u: utterance index
+        '''
+        n = int(np.ceil(len(cached_segs)/len(self.workers)))
+        job_workers = []
+        for w, (process, conn) in enumerate(self.workers):
+            seg_indexes = range(w*n, min((w+1)*n, len(cached_segs)))
+            if len(seg_indexes) == 0:
+                break
+            conn.send((doc_i, u, [(seg_i, cached_segs[seg_i][1].encode(self.data.n_docs)) for seg_i in seg_indexes]))
+            job_workers.append(conn)
+        results = [conn.recv() for conn in job_workers]
+        doc_i_segs = []
+        for worker_results in results:
+            if isinstance(worker_results, Exception):
+                raise worker_results
+            for seg_ll, k, seg_i, k_cluster_ll, k_log_prior in worker_results:
+                cached_seg = cached_segs[seg_i]
+                doc_i_segs.append((seg_ll, None, None, k, (cached_seg[1], cached_seg[2], k_cluster_ll, k_log_prior)))
+        return doc_i_segs
+
+    def start_workers(self):
+        '''
+        Starts the persistent worker processes used when run_parallel is set.
+        The word counts are shared with the workers through memory mapped files,
+        the remaining state of the segmentor is only sent once, when they start.
+        If a worker fails to start the ones already started are stopped.
+        '''
+        self.counts_dir = tempfile.mkdtemp()
+        data = self.data
+        try:
+            counts_shape = data.dump_word_counts(self.counts_dir)
+            self.data = copy.copy(data)
+            self.data.U_W_counts = None
+            self.data.doc_synth = None
+            for w in range(self.n_workers):
+                conn, worker_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=greedy_worker, args=(self, self.counts_dir, counts_shape, worker_conn), daemon=True)
+                process.start()
+                worker_conn.close()
+                self.workers.append((process, conn))
+        except:
+            self.data = data
+            self.stop_workers()
+            raise
+        self.data = data
+
+    def __getstate__(self):
+        #The worker processes are not sent to the workers (when they are not forked)
+        state = self.__dict__.copy()
+        state["workers"] = []
+        return state
+
+    def stop_workers(self):
+        '''
+        Stops the worker processes and removes the shared word counts.
+        Can be called after a partial start_workers and more than once.
+        '''
+        for process, conn in self.workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass #the worker already exited
+            conn.close()
+        for process, conn in self.workers:
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+        self.workers = []
+        if self.counts_dir is not None:
+            shutil.rmtree(self.counts_dir, ignore_errors=True)
+            self.counts_dir = None
+
+    def materialize_segs(self, cached_segs, doc_i, u):
+        '''
+        Builds the segmentations of the candidates that were only scored
+        (by segmentation_ll_bs_batch or by the workers). These are in the format
+        (seg_ll, None, None, k, (parent_u_clusters, parent_tt_chain, k_cluster_ll, k_log_prior)).
+        :param cached_segs: list of tuples in the format (seg_ll, current_u_clusters, tt_chain, k)
+        :param doc_i: document index from which u comes
+        :param u: utterance index
+        '''
+        final_segs = []
+        for seg_result in cached_segs:
+            if seg_result[1] is None:
+                seg_ll, k = seg_result[0], seg_result[3]
+                parent_u_clusters, parent_tt_chain, k_cluster_ll, k_log_prior = seg_result[4]
+                current_u_clusters = self.assign_target_k(u, u, doc_i, k, [k], copy.copy(parent_u_clusters))
+                if self.seg_func_desc == SEG_TT:
+                    #The chain is only recomputed from the first cluster modified by assign_target_k
+                    tt_ll, current_tt_chain = self.segmentation_ll(current_u_clusters, parent_tt_chain)
+                    seg_result = (seg_ll, current_u_clusters, current_tt_chain, k)
+                else:
+                    self.get_k_cluster(k, current_u_clusters).set_cluster_ll(k_cluster_ll)
+                    if self.use_dur_prior and isinstance(current_u_clusters, SegmentationState):
+                        current_u_clusters.log_prior = k_log_prior
+                    seg_result = (seg_ll, current_u_clusters, None, k)
+            final_segs.append(seg_result)
+        return final_segs
+    
     def check_cache(self, doc_i, u, no_dups_doc_i_segs):
-        cached_segs = []
+        beam = Beam(self.max_cache, dedup_key=lambda seg_result: self.get_seg_result_signature(seg_result, doc_i, u))
         gave_warn = False
         cached_correct_seg = False
         found_correct_seg = False
@@ -192,25 +312,17 @@ class MultiDocGreedySeg(AbstractSegmentor):
                 is_correct_seg = True
                 found_correct_seg = True
             
-            is_cached = self.is_cached_seg(seg_ll, cached_segs)
-            if not is_cached:
-                if len(cached_segs) < self.max_cache:
-                    if is_correct_seg:
-                        cached_correct_seg = True
-                    cached_segs.append(seg_result)
-                    cached_segs = sorted(cached_segs, key=operator.itemgetter(0), reverse=True)
-                    
-                elif seg_ll > cached_segs[-1][0]:
-                    if is_correct_seg:
-                        cached_correct_seg = True
-                    cached_segs[-1] = (seg_ll, seg_clusters)
-                    cached_segs = sorted(cached_segs, key=operator.itemgetter(0), reverse=True)
-                elif is_correct_seg and not gave_warn and not cached_correct_seg:
-                    print("\nWARNING NEED CACHE LEN %d"%i)
-                    gave_warn = True
+            kept = beam.push(seg_result)
+            if kept:
+                if is_correct_seg:
+                    cached_correct_seg = True
+            elif kept is not None and is_correct_seg and not gave_warn and not cached_correct_seg:
+                #Only warn if the correct segmentation did not fit (duplicates are None)
+                print("\nWARNING NEED CACHE LEN %d"%i)
+                gave_warn = True
         if not found_correct_seg:
             print("\nLOST CORRECT SEG u: %d"%u)
-        return cached_segs
+        return beam.entries()
     
     def seg_dur_prior_order(self, max_u, n_docs, seg_dur_prior):
         doc_windows = []
@@ -257,42 +369,36 @@ class MultiDocGreedySeg(AbstractSegmentor):
                         u_order.append((u, doc_i))
         return u_order
         
-    def remove_seg_dups(self, doc_i_segs):
+    def get_seg_result_signature(self, seg_result, doc_i, u):
         '''
-        Removes duplicate segmentations based on equal segmentation likehoods.
-        Ensures that the cache does not end up with unecessary duplciates.
-        :param doc_i_segs: list of tuples in the format (seg_ll, current_u_clusters, phi_tt, k)
+        Returns the canonical signature (see get_seg_signature) of a segmentation
+        candidate, which might not have been built yet (see materialize_segs).
         '''
-        doc_i_segs = sorted(doc_i_segs, key=operator.itemgetter(0), reverse=True)
-        no_dups_doc_i_segs = []
-        prev_seg_ll = -np.inf
-        for seg_result in doc_i_segs:
-            seg_ll = seg_result[0]
-            seg_clusters = seg_result[1]
-            if seg_ll != prev_seg_ll:
-                no_dups_doc_i_segs.append(seg_result)
-            prev_seg_ll = seg_ll
-        return no_dups_doc_i_segs
+        if seg_result[1] is None:
+            return self.get_seg_signature(seg_result[4][0], doc_i, u, seg_result[3])
+        return self.get_seg_signature(seg_result[1])
     
-    def topn_cache_prune(self, cached_segs):
-        return cached_segs[:self.max_cache]
+    def topn_cache_prune(self, doc_i_segs, doc_i, u):
+        '''
+        Returns the max_cache segmentations with highest likelihood without duplicates,
+        sorted by likelihood. Candidates are duplicates if they have the same segments
+        and topic partition (see get_seg_signature), whatever their likelihoods.
+        :param doc_i_segs: list of tuples in the format (seg_ll, current_u_clusters, tt_chain, k)
+        '''
+        beam = Beam(self.max_cache, dedup_key=lambda seg_result: self.get_seg_result_signature(seg_result, doc_i, u))
+        beam.extend(doc_i_segs)
+        return beam.entries()
         
-    def k_slot_cache_prune(self, cached_segs):
+    def k_slot_cache_prune(self, doc_i_segs, doc_i, u):
+        '''
+        Returns, for each topic k a sentence was assigned to, the max_cache/max_topics
+        segmentations with highest likelihood without duplicates.
+        :param doc_i_segs: list of tuples in the format (seg_ll, current_u_clusters, tt_chain, k)
+        '''
         max_segs_k = int(self.max_cache/self.max_topics)
-        b = 0
-        doc_i_segs = []
-        k_segs_dict = {}
-        for cached_seg in cached_segs:
-            k = cached_seg[3]
-            if k not in k_segs_dict:
-                k_segs_dict[k] = []
-            k_segs_dict[k].append(cached_seg)
-            
-        for k in k_segs_dict:
-            k_segs = k_segs_dict[k]
-            k_segs = sorted(k_segs, key=operator.itemgetter(0), reverse=True)
-            doc_i_segs += k_segs[:max_segs_k]
-        return doc_i_segs
+        beam = SlotBeam(max_segs_k, operator.itemgetter(3), dedup_key=lambda seg_result: self.get_seg_result_signature(seg_result, doc_i, u))
+        beam.extend(doc_i_segs)
+        return beam.entries()
     
     def greedy_segmentation_step(self, u_order=None):
         '''
@@ -309,7 +415,7 @@ class MultiDocGreedySeg(AbstractSegmentor):
         prev_doc = 0
         with open(self.log_dir+"dp_tracker_"+self.desc+".txt", "a+") as f:
             t = trange(len(u_order), desc='', leave=True)
-            cached_segs = [(-np.inf, [], None)]
+            cached_segs = [(-np.inf, SegmentationState(), None)]
             for i in t:
                 u = u_order[i][0]
                 doc_i = u_order[i][1]
@@ -325,22 +431,19 @@ class MultiDocGreedySeg(AbstractSegmentor):
                     continue
                 
                 if self.run_parallel:
-                    n = int(self.max_cache/(self.n_cpus+1)) #TODO: adjust to number of CPUs
-                    cached_segs_split = [cached_segs[i:i+n] for i in range(0, len(cached_segs), n)]
-                    results = ray.get([compute_seg_ll_parallel.remote(self, cached_segs_job, doc_i, u) for cached_segs_job in cached_segs_split])
-                    doc_i_segs = list(itertools.chain.from_iterable(results))
+                    doc_i_segs = self.compute_seg_ll_parallel(cached_segs, doc_i, u)
                 else:
                     doc_i_segs = self.compute_seg_ll_seq(cached_segs, doc_i, u)
                         
-                no_dups_doc_i_segs = self.remove_seg_dups(doc_i_segs)
-                cached_segs = self.cache_prune(no_dups_doc_i_segs)
+                cached_segs = self.cache_prune(doc_i_segs, doc_i, u)
+                cached_segs = self.materialize_segs(cached_segs, doc_i, u)
                 
                 if self.log_flag:
                     #The code below was assuming we iterated sequentially
                     '''
                     gs_seg = self.data.get_gs_u_clusters(u)
                     if self.seg_func_desc == SEG_TT:
-                        gs_ll, gs_phi_tt = self.segmentation_ll(gs_seg)
+                        gs_ll, gs_tt_chain = self.segmentation_ll(gs_seg)
                     else:
                         gs_ll = self.segmentation_ll(gs_seg)
                     f.write("(%d) gs_ll: %.3f\n\n"%(u, gs_ll))
@@ -358,66 +461,57 @@ class MultiDocGreedySeg(AbstractSegmentor):
         cached_segs = sorted(cached_segs, key=operator.itemgetter(0), reverse=True)
         self.best_segmentation[-1] = cached_segs
         if self.seg_func_desc == SEG_TT:
-            seg_ll_gs, phi_tt = self.segmentation_ll(self.data.get_rho_u_clusters())
+            seg_ll_gs, tt_chain = self.segmentation_ll(self.data.get_rho_u_clusters())
         else:
             seg_ll_gs = self.segmentation_ll(self.data.get_rho_u_clusters())
         
         with open(self.log_dir+"final_phi.txt", "w+") as f_phi:
-            f_phi.write(str(cached_segs[0][2])+"\n"+str(self.data.doc_synth.inv_vocab))
-        print("\nBest found ll: %f\nGS seg_ll: %f\n" % (cached_segs[0][0], seg_ll_gs))
+            phi_tt = None if cached_segs[0][2] is None else cached_segs[0][2].phi
+            f_phi.write(str(phi_tt)+"\n"+str(self.data.doc_synth.inv_vocab))
+        print("\nBest found ll: %f\nGS seg_ll: %f\nLL cache %s\n" % (cached_segs[0][0], seg_ll_gs, str(self.ll_cache)))
         
     def segment_docs(self):
         self.set_gl_data(self.data)
-        self.greedy_segmentation_step(self.u_order)
+        try:
+            if self.run_parallel:
+                self.start_workers()
+            self.greedy_segmentation_step(self.u_order)
+        finally:
+            if self.run_parallel:
+                self.stop_workers()
         
-@ray.remote
-def compute_seg_ll_parallel(segmentor, cached_segs, doc_i, u):
+def greedy_worker(segmentor, counts_dir, counts_shape, conn):
     '''
-    Computes in parallel the segmentation likelihood of assigning u to
-    some topic k starting from a segmetnation in cached_segs
-    :param cached_segs: u_clusters for which we want to know the likelihood
-    :param doc_i: document index from which u comes
-    :param u: utterance index
+    Main loop of the worker processes started by MultiDocGreedySeg.start_workers.
+    Each job has the segmentations (encoded by SegmentationState.encode) the worker
+    has to extend with utterance u, only the candidate scores are sent back. The
+    likelihood cache of the worker is kept between jobs, thus, the topic tracking
+    chains of the decoded segmentations mostly reuse previous computations.
+    :param segmentor: MultiDocGreedySeg without the word counts
+    :param counts_dir: directory with the word counts written by Data.dump_word_counts
+    :param counts_shape: shape of the word counts matrix
+    :param conn: connection to the main process
     '''
+    segmentor.data.load_word_counts(counts_dir, counts_shape)
     segmentor.set_gl_data(segmentor.data)
-    b = 0
-    doc_i_segs = []
-    for cached_seg in cached_segs:
-        cached_u_clusters = cached_seg[1]
-        phi_tt = cached_seg[2]
-        if b == 28:
-            a = 0
-        b += 1
-        possible_clusters = segmentor.get_valid_insert_clusters(doc_i, cached_u_clusters)
-        free_clusters = segmentor.get_free_clusters(cached_u_clusters)
-        test_clusters = []
-        if len(free_clusters) > 0: #The idea is to just test on a single free clusters, since they all give the same likelihood
-            k_free_cluster = free_clusters[0]
-            for k_poss in possible_clusters:
-                if k_poss != k_free_cluster and k_poss in free_clusters:
-                    continue
-                else:
-                    test_clusters.append(k_poss)
-        else:
-            if segmentor.slack_flag:
-                n_doc_i_only_clusters = segmentor.get_doci_only_clusters(doc_i, cached_u_clusters)
-                if n_doc_i_only_clusters < segmentor.topic_slack:
-                    max_k = max(cached_u_clusters, key=attrgetter('k'))
-                    possible_clusters.append(max_k+1)
-            test_clusters = possible_clusters
-        #merge_move_clusters = list(set(range(0, segmentor.max_topics))-set(possible_clusters))
-        #test_clusters = test_clusters+merge_move_clusters
-        test_clusters = segmentor.check_seg_max_len(test_clusters, doc_i, cached_u_clusters) 
-        for k in test_clusters:
-            current_u_clusters = copy.deepcopy(cached_u_clusters)
-            current_u_clusters = segmentor.assign_target_k(u, u, doc_i, k, possible_clusters, current_u_clusters)
-            phi_tt = None
-            if segmentor.seg_func_desc == SEG_TT:
-                seg_ll, phi_tt = segmentor.segmentation_ll(current_u_clusters)
-            else:
-                seg_ll = segmentor.segmentation_ll(current_u_clusters)
-            #This was here before but seems wrong, prior is already added in segmentation_ll (even in pre topic tracking version)
-            #if self.use_dur_prior:
-            #    seg_ll += self.segmentation_log_prior(current_u_clusters)
-            doc_i_segs.append((seg_ll, current_u_clusters, phi_tt, k))
-    return doc_i_segs     
+    while True:
+        job = conn.recv()
+        if job is None:
+            break
+        try:
+            doc_i, u, encoded_segs = job
+            results = []
+            for seg_i, encoded_seg in encoded_segs:
+                u_clusters = SegmentationState.decode(encoded_seg)
+                tt_chain = None
+                if segmentor.seg_func_desc == SEG_TT:
+                    seg_ll, tt_chain = segmentor.segmentation_ll(u_clusters)
+                for seg_result in segmentor.compute_seg_ll_seq([(None, u_clusters, tt_chain)], doc_i, u):
+                    if seg_result[1] is None:
+                        results.append((seg_result[0], seg_result[3], seg_i, seg_result[4][2], seg_result[4][3]))
+                    else:
+                        results.append((seg_result[0], seg_result[3], seg_i, None, None))
+            conn.send(results)
+        except Exception:
+            conn.send(RuntimeError(traceback.format_exc()))
+    conn.close()
\ No newline at end of file
@@ -24,23 +24,16 @@ SEG_VI = "vi_segmentation_step"
 
 class MultiDocVISeg(AbstractSegmentor):
     
-    def __init__(self, alpha,\
-                       data,\
-                       max_topics=None,\
-                       seg_dur=10.0,\
-                       std=3.0,\
-                       use_prior=True,\
-                       n_iters=3,\
+    def __init__(self, data,\
                        seg_config=None,\
+                       n_iters=3,\
                        log_dir="../logs/",\
                        log_flag=True):
-        super(MultiDocVISeg, self).__init__(alpha,\
-                                            data,\
-                                            max_topics=max_topics,\
-                                            seg_dur=seg_dur, std=std,\
-                                            use_prior=use_prior,\
+        super(MultiDocVISeg, self).__init__(data,\
+                                            seg_config=seg_config,\
                                             log_dir=log_dir,\
                                             desc="VI_seg")
+        self.C_beta = np.sum(self.beta)
         self.max_row_cache = 40
         if seg_config is None:
             self.seg_func = self.segment_u_vi_v2
@@ -161,7 +154,7 @@ class MultiDocVISeg(AbstractSegmentor):
         C_beta_E_counts_f2_sum = self.C_beta+np.sum(E_counts_f2)
         #E_q_f2 = np.log(C_beta_E_counts_f2_sum)-(np.sum(Var_counts_f2)/(2.0*(C_beta_E_counts_f2_sum)**2))
         
-        word_mask = np.array([(self.data.W_I_words[words_update]==self.data.W_I_words[wi]).astype(np.int)]).T
+        word_mask = np.array([(self.data.W_I_words[words_update]==self.data.W_I_words[wi]).astype(int)]).T
         E_counts_f1 = E_counts_f2*word_mask
         Var_counts_f1 = np.sum(Var_counts_f2*word_mask)
         C_beta_E_counts_f1_sum = self.beta[self.data.W_I_words[wi]]+np.sum(E_counts_f1)
@@ -209,7 +202,7 @@ class MultiDocVISeg(AbstractSegmentor):
         '''
         segmentation_ll = 0.0
         for u_cluster in u_clusters:
-            qz_counts = np.sum(self.qz[u_cluster.k][u_cluster.wi_list], axis=0)
+            qz_counts = np.sum(self.qz[u_cluster.k][u_cluster.get_words()], axis=0)
             segmentation_ll += self.segment_ll(qz_counts)
         return segmentation_ll
     
@@ -380,8 +373,8 @@ class MultiDocVISeg(AbstractSegmentor):
                 continue
             best_seg_ll = -np.inf
             best_clusters = None
-            k_votes_sorted = self.get_k_votes_sorted(doc_i, u_begin, u_end, final_clusters)
-            possible_clusters = k_votes_sorted[0][0]
+            k_votes_sorted = self.get_k_votes_sorted(doc_i, u_begin, u_end)
+            possible_clusters = [k_votes_sorted[0][0]]
             if len(k_votes_sorted) > 1:
                 possible_clusters.append(k_votes_sorted[1][0])
                 
@@ -394,7 +387,7 @@ class MultiDocVISeg(AbstractSegmentor):
                         break
                     
                 if u_k_cluster is None:
-                    u_k_cluster = SentenceCluster(u_begin, u_end, [doc_i], self.data, k)
+                    u_k_cluster = SentenceCluster(u_begin, u_end, [doc_i], k)
                     u_clusters.append(u_k_cluster)
                 else:
                     u_k_cluster.add_sents(u_begin, u_end, doc_i)
@@ -451,7 +444,9 @@ class MultiDocVISeg(AbstractSegmentor):
         final_u_clusters = []
         for doc_i in range(self.data.n_docs):
             for u in range(self.data.doc_len(doc_i)):
-                k_votes_sorted = self.get_k_votes_sorted(doc_i, u, u, final_u_clusters)
+                #Only topics that keep the segments of doc_i contiguous are considered
+                possible_clusters = self.get_valid_insert_clusters(doc_i, final_u_clusters)
+                k_votes_sorted = [k_vote for k_vote in self.get_k_votes_sorted(doc_i, u, u) if k_vote[0] in possible_clusters]
                 best_ks = [k_votes_sorted[0][0]]
                 if len(k_votes_sorted) > 1:
                     best_ks.append(k_votes_sorted[1][0])
@@ -467,7 +462,7 @@ class MultiDocVISeg(AbstractSegmentor):
                             break
                         
                     if u_k_cluster is None:
-                        u_k_cluster = SentenceCluster(u, u, [doc_i], self.data, k)
+                        u_k_cluster = SentenceCluster(u, u, [doc_i], k)
                         current_u_clusters.append(u_k_cluster)
                     else:
                         u_k_cluster.add_sents(u, u, doc_i)
@@ -477,7 +472,7 @@ class MultiDocVISeg(AbstractSegmentor):
                         best_seg_ll = seg_ll
                         best_u_clusters = current_u_clusters
                 final_u_clusters = best_u_clusters
-        self.best_segmentation[-1] = final_u_clusters
+        self.best_segmentation[-1] = [(best_seg_ll, final_u_clusters)]
         
     def segment_last_line(self, u_begin, u_end, best_seg):
         best_u_clusters =  None
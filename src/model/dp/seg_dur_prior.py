@@ -6,6 +6,8 @@ Created on Sep 6, 2018
 import numpy as np
 from scipy.special import gammaln
 from scipy import stats
+from model.model_tools import gammaln_table
+import model.dp.segmentor as seg
 
 class SegDurPrior(object):
     '''
@@ -16,6 +18,8 @@ class SegDurPrior(object):
         self.segmentation_log_prior = None
         self.dataset_len = data.total_sents
         self.n_docs = data.n_docs
+        self.max_doc_len = data.max_doc_len
+        self.doc_indexes = np.arange(self.n_docs)
         self.docs_hyper_params = [[] for i in range(self.n_docs)]
         
         hyper_params_raw = config["seg_dur_prior_config"][1]
@@ -40,10 +44,14 @@ class SegDurPrior(object):
         
         if prior_dist == "normal":
             self.segmentation_log_prior = self.segmentation_normal_log_prior
+            self.doc_log_prior = None #Depends on all segment lengths, not only on the number of segments and sentences
         elif prior_dist == "beta_bern":
             self.segmentation_log_prior = self.segmentation_beta_bern_log_prior
+            self.doc_log_prior = self.beta_bern_doc_log_prior
         elif prior_dist == "gamma_poisson":
             self.segmentation_log_prior = self.segmentation_gamma_poisson_log_prior
+            self.doc_log_prior = self.gamma_poisson_doc_log_prior
+        self.init_tables(prior_dist)
         """
         hyper_params_raw = config["seg_dur_prior_config"][1]
         if prior_dist == "normal":
@@ -69,6 +77,30 @@ class SegDurPrior(object):
             self.hyper_params = hyper_params_raw
         """
     
+    def init_tables(self, prior_dist):
+        '''
+        Precomputes, for each document, the terms of the prior for all
+        the integer values (segment lengths and number of segments,
+        at most the length of the longest document) they can take.
+        Tables have one row per document.
+        '''
+        sizes = np.arange(self.max_doc_len+1)
+        if prior_dist == "normal":
+            mean = self.docs_hyper_params[0][:, None]
+            std = self.docs_hyper_params[1][:, None]
+            self.normal_log_pdf = -np.log((np.sqrt(2*np.pi*(std**2))))-(sizes-mean)**2/(2*(std**2))
+        elif prior_dist == "beta_bern":
+            alpha = self.docs_hyper_params[0]
+            beta = self.docs_hyper_params[1]
+            self.gammaln_alpha = gammaln_table(self.max_doc_len, alpha)
+            self.gammaln_beta = gammaln_table(self.max_doc_len, beta)
+            self.gammaln_alpha_beta = gammaln_table(self.max_doc_len, alpha+beta)
+        elif prior_dist == "gamma_poisson":
+            alpha = self.docs_hyper_params[0]
+            beta = self.docs_hyper_params[1]
+            self.gammaln_alpha = gammaln_table(self.max_doc_len, alpha)
+            self.log_beta = np.log(sizes+beta[:, None])
+    
     def get_doc_modality(self, doc_name):
             if "html" in doc_name:
                 return "html"
@@ -87,42 +119,78 @@ class SegDurPrior(object):
         return np.array(unpacked_params)
                   
     def normal_log_prior(self, seg_size, doc_i):
-        mean = self.docs_hyper_params[0][doc_i]
-        std = self.docs_hyper_params[1][doc_i]
-        norm_logpdf = -np.log((np.sqrt(2*np.pi*(std**2))))-(seg_size-mean)**2/(2*(std**2))
-        return norm_logpdf
-        
-    def segmentation_normal_log_prior(self, u_clusters):
-        log_prior = 0.0
+        return self.normal_log_pdf[doc_i, seg_size]
+    
+    def get_seg_lens(self, u_clusters):
+        '''
+        Returns the arrays with the document and the length of each segment
+        in u_clusters, the only information the priors depend on.
+        '''
+        docs = []
+        seg_lens = []
         for u_cluster in u_clusters:
             for doc_i in u_cluster.get_docs():
                 u_begin, u_end = u_cluster.get_segment(doc_i)
-                seg_size = u_end-u_begin+1
-                log_prior += self.normal_log_prior(seg_size, doc_i)
-        return log_prior
+                docs.append(doc_i)
+                seg_lens.append(u_end-u_begin+1)
+        return np.array(docs, dtype=np.int64), np.array(seg_lens, dtype=np.int64)
+    
+    def get_doc_n_sents(self, u_clusters):
+        '''
+        Returns the arrays with the number of segments and the number of sentences
+        of each document, the sufficient statistics of the beta_bern and gamma_poisson
+        priors. These are read from the indexes of a SegmentationState when available.
+        '''
+        if isinstance(u_clusters, seg.SegmentationState):
+            n_segs = np.zeros(self.n_docs, dtype=np.int64)
+            n_sents = np.zeros(self.n_docs, dtype=np.int64)
+            for doc_i, doc_i_n_sents in u_clusters.doc_n_sents.items():
+                n_segs[doc_i] = len(u_clusters.doc_index[doc_i])
+                n_sents[doc_i] = doc_i_n_sents
+            return n_segs, n_sents
+        docs, seg_lens = self.get_seg_lens(u_clusters)
+        n_segs = np.bincount(docs, minlength=self.n_docs)
+        n_sents = np.bincount(docs, weights=seg_lens, minlength=self.n_docs).astype(np.int64)
+        return n_segs, n_sents
+    
+    def log_prior_delta(self, doc_i, n_segs, n_sents, prev_seg_len, seg_len):
+        '''
+        Returns the change in the log prior of a segmentation when a segment of doc_i
+        changes its length from prev_seg_len to seg_len (prev_seg_len is 0 for a new
+        segment). Only the term of doc_i changes and it is obtained in constant time.
+        :param n_segs: number of segments of doc_i before the change
+        :param n_sents: number of sentences of doc_i before the change
+        '''
+        if self.doc_log_prior is None:
+            #normal prior, each segment has its own term
+            delta = self.normal_log_pdf[doc_i, seg_len]
+            if prev_seg_len > 0:
+                delta -= self.normal_log_pdf[doc_i, prev_seg_len]
+            return delta
+        new_n_segs = n_segs+1 if prev_seg_len == 0 else n_segs
+        new_n_sents = n_sents+seg_len-prev_seg_len
+        return self.doc_log_prior(doc_i, new_n_segs, new_n_sents)-self.doc_log_prior(doc_i, n_segs, n_sents)
+    
+    def segmentation_normal_log_prior(self, u_clusters):
+        docs, seg_lens = self.get_seg_lens(u_clusters)
+        return np.sum(self.normal_log_pdf[docs, seg_lens])
     
     def segmentation_beta_bern_log_prior(self, u_clusters):
-        f1 = np.zeros(self.n_docs)
-        f2 = np.zeros(self.n_docs)
-        denom = np.zeros(self.n_docs)
-        for u_cluster in u_clusters:
-            for doc_i in u_cluster.get_docs():
-                u_begin, u_end = u_cluster.get_segment(doc_i)
-                seg_len = u_end-u_begin+1
-                f1[doc_i] += 1.0
-                f2[doc_i] += seg_len
-                denom[doc_i] += seg_len
-        
-        alpha = self.docs_hyper_params[0]
-        beta = self.docs_hyper_params[1]
-        f2 -= f1
-        f1 += alpha
-        f2 += beta
-        denom += alpha+beta
-        log_prior = np.sum(gammaln(f1)+gammaln(f2)-gammaln(denom))
-        return log_prior
+        return np.sum(self.beta_bern_doc_log_prior(self.doc_indexes, *self.get_doc_n_sents(u_clusters)))
+    
+    def beta_bern_doc_log_prior(self, doc_i, n_segs, n_sents):
+        '''
+        Returns the log prior of the documents doc_i (a single one or an array)
+        given their number of segments and sentences.
+        '''
+        return self.gammaln_alpha[doc_i, n_segs]+\
+               self.gammaln_beta[doc_i, n_sents-n_segs]-\
+               self.gammaln_alpha_beta[doc_i, n_sents]
     
     def segmentation_gamma_poisson_log_prior(self, u_clusters):
+        return np.sum(self.gamma_poisson_doc_log_prior(self.doc_indexes, *self.get_doc_n_sents(u_clusters)))
+    
+    def gamma_poisson_doc_log_prior(self, doc_i, n_rho1, n):
         '''
         #[alpha, beta, lambda_hp, interval]
         doc_lens = np.zeros(self.n_docs)
@@ -146,20 +214,8 @@ class SegDurPrior(object):
         f2 = -lambda_adjusted*(n+beta)
         log_prior = np.sum(f1+f2)
         '''
-        
-        n_rho1 = np.zeros(self.n_docs)
-        n = np.zeros(self.n_docs)
-        for u_cluster in u_clusters:
-            for doc_i in u_cluster.get_docs():
-                u_begin, u_end = u_cluster.get_segment(doc_i)
-                seg_len = u_end-u_begin+1
-                n_rho1[doc_i] += 1.0
-                n[doc_i] += seg_len
-                
-        alpha = self.docs_hyper_params[0]
-        beta = self.docs_hyper_params[1]
-        f1 = gammaln(n_rho1+alpha)
-        f2 = (n_rho1+alpha)*np.log(n+beta)
-        log_prior = np.sum(f1-f2)
-        return log_prior
+        alpha = self.docs_hyper_params[0][doc_i]
+        f1 = self.gammaln_alpha[doc_i, n_rho1]
+        f2 = (n_rho1+alpha)*self.log_beta[doc_i, n]
+        return f1-f2
                 
\ No newline at end of file
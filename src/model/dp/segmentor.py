@@ -5,13 +5,15 @@ Created on Feb 22, 2018
 '''
 import numpy as np
 import copy
+from scipy import sparse
 from scipy.special import gammaln
 from scipy.special import digamma
 import os
 import collections
 import dirichlet
 import model.dp.seg_dur_prior as sdp
-from utils.fast_digamma import digamma_cython_d, digamma_cython_np
+from model.model_tools import LRUCache, gammaln_table
+from utils.fast_digamma import digamma_cython_d, digamma_cython_np, topic_tracking_update_cython
 
 GL_DATA = None
 SEG_BL = "seg_bl" #as in base line segmentation
@@ -39,7 +41,9 @@ class AbstractSegmentor(object):
         if seg_config is None or seg_config["seg_func"] == SEG_BL:
             self.seg_func_desc = SEG_BL
             self.segmentation_ll = self.segmentation_ll_bs
-            self.seg_ll_C = gammaln(self.beta.sum())-gammaln(self.beta).sum()
+            self.beta_sum = self.beta.sum()
+            self.seg_ll_C = gammaln(self.beta_sum)-gammaln(self.beta).sum()
+            self.init_gammaln_tables()
         elif seg_config["seg_func"] == SEG_TT:
             self.seg_func_desc = SEG_TT
             self.segmentation_ll = self.segmentation_ll_topic_tracking
@@ -51,13 +55,23 @@ class AbstractSegmentor(object):
                 alpha_smooth = 0.8
                 self.phi_tt_t0 = (self.phi_tt_t0+alpha_smooth)/(np.sum(self.phi_tt_t0*1.0)+alpha_smooth*self.data.W)
             '''
+            
+        #Cluster log likelihoods by cluster contents (for seg_tt entries also keep alpha and phi, thus, fewer of them fit)
+        if "ll_cache_size" in seg_config:
+            self.ll_cache = LRUCache(seg_config["ll_cache_size"])
+        elif self.seg_func_desc == SEG_TT:
+            self.ll_cache = LRUCache(1000)
+        else:
+            self.ll_cache = LRUCache(100000)
         
         if seg_config["fast_digamma"]:
             self.digamma_np = digamma_cython_np
             self.digamma_d = digamma_cython_d
+            self.topic_tracking_update = topic_tracking_update_cython
         else:
             self.digamma_np = digamma
             self.digamma_d = digamma
+            self.topic_tracking_update = self.topic_tracking_update_np
             
         os.remove(self.log_dir+"dp_tracker_"+self.desc+".txt") if os.path.exists(self.log_dir+"dp_tracker_"+self.desc+".txt") else None
 
@@ -75,6 +89,25 @@ class AbstractSegmentor(object):
             print("ERROR: unknown prior tyoe %s"%prior_type)
             return None
         
+    def init_gammaln_tables(self):
+        '''
+        Precomputes gammaln(n+beta[w]) for all the counts n that vocabulary entry w
+        can have in a cluster (at most its count in the full collection) and
+        gammaln(n+beta_sum) for all cluster sizes. The tables of all vocabulary
+        entries are concatenated, the one of w starts at gammaln_beta_offsets[w].
+        When beta is symmetric all vocabulary entries share the same table.
+        '''
+        max_counts = np.asarray(self.data.U_W_counts.sum(axis=0)).ravel()
+        if np.all(self.beta == self.beta[0]):
+            self.gammaln_beta = gammaln_table(np.max(max_counts), self.beta[0])
+            self.gammaln_beta_offsets = np.zeros(self.W, dtype=np.int64)
+        else:
+            table_lens = max_counts+1
+            self.gammaln_beta_offsets = np.cumsum(table_lens)-table_lens
+            counts = np.arange(np.sum(table_lens))-np.repeat(self.gammaln_beta_offsets, table_lens)
+            self.gammaln_beta = gammaln(counts+np.repeat(self.beta, table_lens))
+        self.gammaln_beta_sum = gammaln_table(self.data.total_words, self.beta_sum)
+        
     def set_gl_data(self, data):
         global GL_DATA
         GL_DATA = data
@@ -104,6 +137,8 @@ class AbstractSegmentor(object):
         return rho
             
     def get_cluster_order(self, doc_i, u_clusters):
+        if isinstance(u_clusters, SegmentationState):
+            return u_clusters.get_cluster_order(doc_i)
         cluster_k_list = []
         for u_cluster in u_clusters:
             if u_cluster.has_doc(doc_i):
@@ -127,6 +162,8 @@ class AbstractSegmentor(object):
                     return ordered_clusters
                 
     def get_free_clusters(self, u_clusters):
+        if isinstance(u_clusters, SegmentationState):
+            return [k for k in range(self.max_topics) if k not in u_clusters.k_index]
         free_clusters = list(range(self.max_topics))
         for u_cluster in u_clusters:
             if u_cluster.k >= self.max_topics: #we can get here if using topic_slack
@@ -182,6 +219,9 @@ class AbstractSegmentor(object):
         :param doc_i: document index
         :param u_clusters: list of sentence cluster corresponding to a segmentation
         '''
+        if isinstance(u_clusters, SegmentationState):
+            doc_i_clusters = u_clusters.doc_index.get(doc_i)
+            return u_clusters.k_index[doc_i_clusters[-1]] if doc_i_clusters else 0
         last_sent = -1
         last_cluster = -1
         for cluster_i, u_cluster in enumerate(u_clusters):
@@ -197,6 +237,10 @@ class AbstractSegmentor(object):
     def get_valid_insert_clusters(self, doc_i, u_clusters):
         if len(u_clusters) == 0:
             return range(0, self.max_topics)
+        if isinstance(u_clusters, SegmentationState):
+            #All topics of doc_i except the last one
+            invalid_clusters = set(u_clusters.doc_index.get(doc_i, [])[:-1])
+            return list(set(range(0, self.max_topics))-invalid_clusters)
         last_sent = -1
         last_cluster_i = -1
         u_clusters_with_doc_i = []
@@ -246,12 +290,16 @@ class AbstractSegmentor(object):
         return words
     
     def get_k_cluster(self, k, u_clusters):
+        if isinstance(u_clusters, SegmentationState):
+            return u_clusters.get_k_cluster(k)
         for u_cluster in u_clusters:
             if u_cluster.k == k:
                 return u_cluster
         return None
     
     def get_k_cluster_index(self, k, u_clusters):
+        if isinstance(u_clusters, SegmentationState):
+            return u_clusters.get_k_cluster_index(k)
         for i, u_cluster in enumerate(u_clusters):
             if u_cluster.k == k:
                 return i
@@ -267,6 +315,8 @@ class AbstractSegmentor(object):
         return next_u_cluster
     
     def get_u_segment(self, doc_i, u, u_clusters):
+        if isinstance(u_clusters, SegmentationState):
+            u_clusters = [u_clusters.get_k_cluster(k) for k in u_clusters.doc_index.get(doc_i, [])]
         for u_cluster in u_clusters:
             if u_cluster.has_doc(doc_i):
                 u_begin, u_end = u_cluster.get_segment(doc_i)
@@ -274,6 +324,8 @@ class AbstractSegmentor(object):
                     return u_cluster.k, u_begin, u_end
                 
     def get_doc_i_clusters(self, doc_i, u_clusters):
+        if isinstance(u_clusters, SegmentationState):
+            return sorted(u_clusters.doc_index.get(doc_i, []), key=u_clusters.k_index.get)
         k_list = []
         for u_cluster in u_clusters:
             if u_cluster.has_doc(doc_i):
@@ -289,36 +341,78 @@ class AbstractSegmentor(object):
         return c
             
     def assign_target_k(self, u_begin, u_end, doc_i, k_target, possible_clusters, u_clusters):
+        '''
+        Assigns the sentences u_begin to u_end of doc_i to the cluster with topic k_target.
+        Clusters in u_clusters are shared with other segmentations, thus, a cluster
+        is copied before being modified and the copy replaces it in u_clusters.
+        '''
         i = self.get_k_cluster_index(k_target, u_clusters)
         if i is not None:
-            u_k_target_cluster = u_clusters[i]
-            u_k_target_cluster = copy.deepcopy(u_k_target_cluster)
+            u_k_target_cluster = u_clusters[i].copy()
             u_k_target_cluster.set_cluster_ll(None)
-            u_clusters[i] = u_k_target_cluster
             u_k_target_cluster.add_sents(u_begin, u_end, doc_i)
+            #Only replaced after adding the sentences so that a SegmentationState indexes the segment of doc_i
+            #(merging the following segments below does not change its beginning)
+            u_clusters[i] = u_k_target_cluster
             if k_target not in possible_clusters:
                 u_begin_k_target, u_end_k_target = u_k_target_cluster.get_segment(doc_i)
                 for k in range(self.max_topics):
                     if k == k_target:
                         continue
                     
-                    u_k_cluster = self.get_k_cluster(k, u_clusters)
-                    if u_k_cluster is None:
+                    j = self.get_k_cluster_index(k, u_clusters)
+                    if j is None:
                         continue
                     
+                    u_k_cluster = u_clusters[j]
                     if u_k_cluster.has_doc(doc_i):
                         u_begin_di, u_end_di = u_k_cluster.get_segment(doc_i)
                         if u_begin_di > u_begin_k_target:
-                            doc_i_word_counts = np.sum(self.data.doc_word_counts(doc_i)[u_begin_di:u_end_di+1], axis=0)
-                            u_k_cluster.remove_doc(doc_i, doc_i_word_counts)
+                            u_k_cluster = u_k_cluster.copy()
+                            u_k_cluster.set_cluster_ll(None)
+                            u_k_cluster.remove_doc(doc_i)
                             if len(u_k_cluster.get_docs()) == 0:
-                                u_clusters.remove(u_k_cluster)
+                                u_clusters.pop(j)
+                            else:
+                                u_clusters[j] = u_k_cluster
                             u_k_target_cluster.add_sents(u_begin_di, u_end_di, doc_i)
         else:
             u_k_cluster = SentenceCluster(u_begin, u_end, [doc_i], k_target)
             u_clusters.append(u_k_cluster)
         return u_clusters
     
+    def get_seg_signature(self, u_clusters, doc_i=None, u=None, k=None):
+        '''
+        Returns a canonical representation of a segmentation: the document, last
+        sentence and topic label of each segment. Topics are relabeled by order
+        of appearance, thus, segmentations that only differ by the labels of
+        their topics have the same signature. In seg_tt mode the label is the
+        position of the cluster in u_clusters instead (the order of the clusters
+        defines the topic tracking chain).
+        If doc_i is given, the signature is the one after assigning sentence u
+        of doc_i to topic k (k must be a valid insert cluster).
+        '''
+        labels = {}
+        signature = []
+        for doc_j in range(self.data.n_docs):
+            cluster_order = self.get_cluster_order(doc_j, u_clusters)
+            seg_ends = [self.get_k_cluster(k_j, u_clusters).get_segment(doc_j)[1] for k_j in cluster_order]
+            if doc_j == doc_i:
+                if len(cluster_order) > 0 and cluster_order[-1] == k:
+                    seg_ends[-1] = u
+                else:
+                    cluster_order.append(k)
+                    seg_ends.append(u)
+            for k_j, u_end in zip(cluster_order, seg_ends):
+                if k_j not in labels:
+                    if self.seg_func_desc == SEG_TT:
+                        k_index = self.get_k_cluster_index(k_j, u_clusters)
+                        labels[k_j] = len(u_clusters) if k_index is None else k_index
+                    else:
+                        labels[k_j] = len(labels)
+                signature.append((doc_j, u_end, labels[k_j]))
+        return tuple(signature)
+    
     def is_cached_seg(self, seg_ll, cached_segs):
         is_cached = False
         for cached_seg in cached_segs:
@@ -332,9 +426,28 @@ class AbstractSegmentor(object):
         return is_cached
     
     def segmentation_log_prior(self, u_clusters):
+        if isinstance(u_clusters, SegmentationState):
+            if u_clusters.log_prior is None:
+                u_clusters.log_prior = self.prior_class.segmentation_log_prior(u_clusters)
+            return u_clusters.log_prior
         log_prior = self.prior_class.segmentation_log_prior(u_clusters)
         return log_prior
     
+    def get_doc_stats(self, doc_i, u_clusters):
+        '''
+        Returns the number of segments and sentences of doc_i in u_clusters
+        and the length of its last segment (0 if doc_i has no segments).
+        '''
+        cluster_order = self.get_cluster_order(doc_i, u_clusters)
+        if len(cluster_order) == 0:
+            return 0, 0, 0
+        u_begin, u_end = self.get_k_cluster(cluster_order[-1], u_clusters).get_segment(doc_i)
+        if isinstance(u_clusters, SegmentationState):
+            n_sents = u_clusters.doc_n_sents[doc_i]
+        else:
+            n_sents = sum([u_cluster.get_segment(doc_i)[1]-u_cluster.get_segment(doc_i)[0]+1 for u_cluster in u_clusters if u_cluster.has_doc(doc_i)])
+        return len(cluster_order), n_sents, u_end-u_begin+1
+    
     def segment_ll(self, word_counts):
         '''
         Returns the likelihood if we considering all sentences (word_counts)
@@ -342,11 +455,47 @@ class AbstractSegmentor(object):
         :param seg_word_counts: vector with the size equal to the length of
         the vocabulary and values with the corresponding word counts.
         '''
-        f1 = gammaln(word_counts+self.beta).sum()
-        f2 = gammaln((word_counts+self.beta).sum())
+        if word_counts.dtype.kind in "iu":
+            #Integer counts are looked up in the gammaln tables
+            f1 = self.gammaln_beta[self.gammaln_beta_offsets+word_counts].sum()
+            f2 = self.gammaln_beta_sum[word_counts.sum()]
+        else:
+            f1 = gammaln(word_counts+self.beta).sum()
+            f2 = gammaln((word_counts+self.beta).sum())
         seg_ll = self.seg_ll_C+f1-f2
         return seg_ll
     
+    def segment_ll_delta(self, word_counts, n_words, seg_ll, w_indexes, w_counts):
+        '''
+        Returns the likelihood of a segment after adding w_counts to the counts of
+        the vocabulary entries w_indexes (negative counts remove words). Only these
+        entries are evaluated, the remaining terms of segment_ll do not change.
+        Supports several segments at once (one per row of word_counts).
+        :param word_counts: current (integer) counts of the segment for the w_indexes entries
+        :param n_words: current (integer) total number of words of the segment
+        :param seg_ll: current log likelihood of the segment (0.0 if the segment is empty)
+        '''
+        table_indexes = self.gammaln_beta_offsets[w_indexes]+word_counts
+        f1 = (self.gammaln_beta[table_indexes+w_counts]-self.gammaln_beta[table_indexes]).sum(axis=-1)
+        f2 = self.gammaln_beta_sum[n_words+np.sum(w_counts)]-self.gammaln_beta_sum[n_words]
+        return seg_ll+f1-f2
+    
+    def cluster_ll_bs(self, u_cluster):
+        '''
+        Returns the log likelihood of u_cluster. If it is not cached in the
+        cluster, it is looked up in ll_cache by the cluster contents
+        (clusters with the same segments are found in many segmentations).
+        '''
+        cluster_ll = u_cluster.get_cluster_ll()
+        if cluster_ll is None:
+            signature = u_cluster.get_signature()
+            cluster_ll = self.ll_cache.get(signature)
+            if cluster_ll is None:
+                cluster_ll = self.segment_ll(u_cluster.get_word_counts())
+                self.ll_cache.put(signature, cluster_ll)
+            u_cluster.set_cluster_ll(cluster_ll)
+        return cluster_ll
+    
     def segmentation_ll_bs(self, u_clusters):
         '''
         Returns the log likelihood of the segmentation of all documents.
@@ -355,21 +504,64 @@ class AbstractSegmentor(object):
         
         segmentation_ll = 0.0
         for u_cluster in u_clusters:
-            cached_ll = u_cluster.get_cluster_ll()
-            if cached_ll is not None:
-                cluster_ll = cached_ll
-            else:
-                word_counts = u_cluster.get_word_counts()
-                cluster_ll = self.segment_ll(word_counts)
-                u_cluster.set_cluster_ll(cluster_ll)
-            
-            segmentation_ll += cluster_ll
+            segmentation_ll += self.cluster_ll_bs(u_cluster)
             
         if self.use_dur_prior:
             segmentation_ll += self.segmentation_log_prior(u_clusters)
                                 
         return segmentation_ll
     
+    def segmentation_ll_bs_batch(self, u_clusters, u_begin, u_end, doc_i, test_clusters):
+        '''
+        Returns the log likelihood of all segmentations obtained by assigning the
+        sentences u_begin to u_end of doc_i to each topic in test_clusters, without
+        building them. Only the vocabulary entries of the new sentences change, thus,
+        their counts in the modified clusters are stacked in a K x nnz matrix and
+        scored with segment_ll_delta (a new cluster is a delta from an empty one).
+        The topics in test_clusters must be valid insert clusters (see get_valid_insert_clusters)
+        and u_begin must follow the current segment of doc_i.
+        :param u_clusters: list of SentenceCluster corresponding to the segmentation being extended
+        :return: arrays with the segmentation log likelihood, the log likelihood
+        of the modified cluster and the log prior of the segmentation (nan if
+        use_dur_prior is False) for each topic in test_clusters
+        '''
+        seg_ll = 0.0
+        for u_cluster in u_clusters:
+            seg_ll += self.cluster_ll_bs(u_cluster)
+        
+        w_indexes, w_counts = self.data.seg_sparse_word_counts(doc_i, u_begin, u_end)
+        word_counts = np.zeros((len(test_clusters), len(w_indexes)), dtype=np.int64)
+        n_words = np.zeros(len(test_clusters), dtype=np.int64)
+        prev_cluster_ll = np.zeros(len(test_clusters))
+        extends_seg = np.zeros(len(test_clusters), dtype=bool)
+        for i, k in enumerate(test_clusters):
+            u_cluster = self.get_k_cluster(k, u_clusters)
+            if u_cluster is None:
+                continue
+            word_counts[i] = u_cluster.get_word_counts()[w_indexes]
+            n_words[i] = u_cluster.get_n_words()
+            prev_cluster_ll[i] = u_cluster.get_cluster_ll()
+            extends_seg[i] = u_cluster.has_doc(doc_i)
+        
+        k_cluster_ll = self.segment_ll_delta(word_counts, n_words, prev_cluster_ll, w_indexes, w_counts)
+        seg_lls = seg_ll-prev_cluster_ll+k_cluster_ll
+        k_log_prior = np.full(len(test_clusters), np.nan)
+        
+        if self.use_dur_prior:
+            #The prior only depends on segment durations, thus, it is the same for all
+            #topics that extend the current segment of doc_i (at most one) and for all
+            #topics that start a new segment. Only the term of doc_i changes.
+            log_prior = self.segmentation_log_prior(u_clusters)
+            n_segs, n_sents, last_seg_len = self.get_doc_stats(doc_i, u_clusters)
+            new_sents = min(u_end, self.data.doc_len(doc_i)-1)-u_begin+1
+            if np.any(extends_seg):
+                k_log_prior[extends_seg] = log_prior+self.prior_class.log_prior_delta(doc_i, n_segs, n_sents, last_seg_len, last_seg_len+new_sents)
+            if not np.all(extends_seg):
+                k_log_prior[~extends_seg] = log_prior+self.prior_class.log_prior_delta(doc_i, n_segs, n_sents, 0, new_sents)
+            seg_lls += k_log_prior
+                
+        return seg_lls, k_cluster_ll, k_log_prior
+    
     def segmentation_ll_opt_beta(self, u_clusters):
         '''
         Returns the log likelihood of the segmentation of all documents.
@@ -387,7 +579,10 @@ class AbstractSegmentor(object):
         except:
             print("WARNING: dirichlet.mle did not converge, defaulting to first prior")
             self.beta = self.first_beta
-        self.seg_ll_C = gammaln(self.beta.sum())-gammaln(self.beta).sum()
+        self.beta_sum = self.beta.sum()
+        self.seg_ll_C = gammaln(self.beta_sum)-gammaln(self.beta).sum()
+        self.init_gammaln_tables()
+        self.ll_cache.clear() #The cached log likelihoods used the previous beta
             
         segmentation_ll = 0.0
         for u_cluster in u_clusters:
@@ -411,47 +606,77 @@ class AbstractSegmentor(object):
             alpha_t = alpha_t_new
         return alpha_t
     
-    def get_topic_tracking_prior(self, u_clusters):#TODO: deal with t=0
+    def topic_tracking_update_np(self, w_indexes, w_counts, n_words, phi_t, alpha_t, phi_t_update):
+        '''
+        Numpy version of topic_tracking_update_cython. Computes the alpha update,
+        writes the phi update into phi_t_update and returns the updated alpha
+        and the log likelihood of the cluster. Only the nonzero counts of the
+        cluster are used, the digamma and gammaln terms of the vocabulary
+        entries with zero counts cancel exactly.
+        :param w_indexes: vocabulary indexes of the words in the cluster
+        :param w_counts: counts of the w_indexes words
+        :param n_words: number of words in the cluster
+        :param phi_t: phi of the previous cluster in the topic tracking chain
+        '''
+        phi_t_nz = phi_t[w_indexes]
+        #update alpha
+        num_alpha_update = np.sum(phi_t_nz*(self.digamma_np(w_counts+alpha_t*phi_t_nz)-self.digamma_np(alpha_t*phi_t_nz)))
+        denom_alpha_update = self.digamma_d(n_words+alpha_t)-self.digamma_d(alpha_t)
+        alpha_t_update= alpha_t*(num_alpha_update/denom_alpha_update)
+        
+        #current phi estimation
+        denom_phi_tt = n_words+alpha_t_update
+        np.multiply(phi_t, alpha_t_update/denom_phi_tt, out=phi_t_update)
+        phi_t_update[w_indexes] = (w_counts+alpha_t_update*phi_t_nz)/denom_phi_tt #NOTE: I was using alpha_t before
+        
+        f1 = (gammaln(w_counts+alpha_t_update*phi_t_nz)-gammaln(alpha_t_update*phi_t_nz)).sum()
+        f2 = gammaln(denom_phi_tt)
+        C = gammaln(alpha_t_update)
+        cluster_ll = C+f1-f2
+        return alpha_t_update, cluster_ll
+    
+    def get_topic_tracking_prior(self, u_clusters, tt_chain=None):#TODO: deal with t=0
+        '''
+        Returns the TopicTrackingChain of u_clusters. The chain of the segmentation
+        u_clusters was derived from (tt_chain) is reused up to the first cluster
+        that is not the same object in both segmentations (modified clusters are
+        always copies), only the clusters from that point onward are recomputed.
+        :param u_clusters: list of SentenceCluster
+        :param tt_chain: TopicTrackingChain of a previous segmentation (None to compute from scratch)
+        '''
         #Computing beta and theta for t=0, which is the word probability
         #distribution for the first cluster. 
         #Another possibility is compute from the collection
         #alpha_smooth = 0.8
         #phi = [(u_clusters[0].get_word_counts()+alpha_smooth)/(np.sum(u_clusters[0].get_word_counts()*1.0)+alpha_smooth*self.data.W)] 
-        phi = [self.phi_tt_t0]
         alpha_t = self.alpha_tt_t0
-        alpha = []
-        broke_chain = False
-        for t, u_cluster in enumerate(u_clusters):
-            cluster_ll = u_cluster.get_cluster_ll()
-            alpha_t_update = None
-            phi_t_update = None
-            if cluster_ll is None or broke_chain:
-                if cluster_ll is not None:
-                    u_cluster = copy.deepcopy(u_cluster)
-                    u_clusters[t] = u_cluster
+        t_begin = 0
+        if tt_chain is not None:
+            t_begin = tt_chain.common_prefix_len(u_clusters)
+            tt_chain = tt_chain.prefix(t_begin)
+        else:
+            tt_chain = TopicTrackingChain(self.phi_tt_t0)
+            
+        for t in range(t_begin, len(u_clusters)):
+            u_cluster = u_clusters[t]
+            #The parameters of cluster t depend on its contents and on the contents of all previous clusters
+            #The full key (not its hash) is used so that different chains never share an entry
+            chain_key = (tt_chain.keys[t], u_cluster.get_signature())
+            cached_update = self.ll_cache.get(chain_key)
+            if cached_update is None:
                 word_counts = u_cluster.get_word_counts()
-                #update alpha
-                num_alpha_update = np.sum(phi[t]*(self.digamma_np(word_counts+alpha_t*phi[t])-self.digamma_np(alpha_t*phi[t])))
-                denom_alpha_update = self.digamma_d(np.sum(word_counts)+alpha_t)-self.digamma_d(alpha_t)
-                alpha_t_update= alpha_t*(num_alpha_update/denom_alpha_update)
+                w_indexes = np.flatnonzero(word_counts)
+                #alpha, phi and the cluster log likelihood are computed together
+                phi_t_update = np.empty(self.W)
+                alpha_t_update, cluster_ll = self.topic_tracking_update(w_indexes, word_counts[w_indexes], u_cluster.get_n_words(),\
+                                                                        tt_chain.phi[t], alpha_t, phi_t_update)
                 #alpha_t = self.fix_point_est_alpha(phi[t], word_counts)
-                
-                #current phi estimation
-                num_phi_tt = word_counts+alpha_t_update*phi[t] #NOTE: I was using alpha_t before
-                denom_phi_tt = np.sum(word_counts)+alpha_t_update
-                phi_t_update = num_phi_tt/denom_phi_tt
-                broke_chain = True
-                u_cluster.set_cluster_ll(None)
-                u_cluster.set_alpha_tt(alpha_t_update)
-                u_cluster.set_phi_tt(phi_t_update)
+                self.ll_cache.put(chain_key, (alpha_t_update, phi_t_update, cluster_ll))
             else:
-                alpha_t_update = u_cluster.get_alpha_tt()
-                phi_t_update = u_cluster.get_phi_tt()
-                
-            alpha.append(alpha_t_update)
-            phi.append(phi_t_update)
+                alpha_t_update, phi_t_update, cluster_ll = cached_update
+            tt_chain.append(u_cluster, alpha_t_update, phi_t_update, cluster_ll, chain_key)
             
-        return alpha, phi
+        return tt_chain
     
     def get_topic_tracking_prior_new(self, u_clusters):
         '''
@@ -478,30 +703,24 @@ class AbstractSegmentor(object):
             
         return alpha, phi
     
-    def segmentation_ll_topic_tracking(self, u_clusters):
+    def segmentation_ll_topic_tracking(self, u_clusters, tt_chain=None):
         '''
-        Returns the log likelihood of the segmentation of all documents. Uses
-        a dynamic topic modeling based on Shinji Watanabe 2010.
+        Returns the log likelihood of the segmentation of all documents and its
+        TopicTrackingChain. Uses a dynamic topic modeling based on Shinji Watanabe 2010.
         :param u_clusters: list of SentenceCluster corresponding to the best segmentation up to u-1
+        :param tt_chain: TopicTrackingChain of the segmentation u_clusters was derived from
         '''
-        segmentation_ll = 0.0
         #u_clusters = self.order_cluster(u_clusters)
-        alpha, phi_tt = self.get_topic_tracking_prior(u_clusters)
-        for alpha_t, phi_t, u_cluster in zip(alpha, phi_tt[:-1], u_clusters):
-            cluster_ll = u_cluster.get_cluster_ll()
-            if cluster_ll is None:
-                word_counts = u_cluster.get_word_counts()
-                f1 = gammaln(word_counts+alpha_t*phi_t).sum()
-                f2 = gammaln(word_counts.sum()+alpha_t)
-                C = gammaln(alpha_t)-gammaln(alpha_t*phi_t).sum()
-                cluster_ll = C+f1-f2
-                u_cluster.set_cluster_ll(cluster_ll)
+        #get_topic_tracking_prior also computes the log likelihood of the clusters
+        tt_chain = self.get_topic_tracking_prior(u_clusters, tt_chain)
+        segmentation_ll = 0.0
+        for cluster_ll in tt_chain.cluster_lls:
             segmentation_ll += cluster_ll
             
         if self.use_dur_prior: #this is the prior on segment duration
             segmentation_ll += self.segmentation_log_prior(u_clusters)
                                 
-        return segmentation_ll, phi_tt
+        return segmentation_ll, tt_chain
     
     def dp_segmentation_step(self):
         with open(self.log_dir+"dp_tracker_"+self.desc+".txt", "a+") as f:
@@ -540,34 +759,65 @@ class Data(object):
     def __init__(self, docs):
         self.doc_synth = docs
         self.doc_names = docs.doc_names
-        self.docs_rho_gs = [doc.rho for doc in docs.get_single_docs()]
+        self.docs_rho_gs = self.rho_slicer(docs)
         self.doc_rho_topics = docs.doc_rho_topics
         self.docs_index = docs.docs_index
         self.W = docs.W
         self.W_I_words = docs.W_I_words #Vector the vocabulary indexes of ith word in the full collection
         self.d_u_wi_indexes = docs.d_u_wi_indexes #Contains the a list of word indexes organizes by document and by sentence
         self.n_docs = docs.n_docs
+        self.U_W_counts = sparse.csr_matrix(docs.U_W_counts, dtype=np.int64) #Word counts (CSR matrix) of the full collection, shared by all documents
         self.doc_lens = []
-        self.docs_word_counts = []
+        self.docs_begin = [] #Index of the first sentence of each document in U_W_counts
         self.multi_doc_slicer(docs)
         self.max_doc_len = np.max(self.doc_lens)
-        self.total_sents = 0
-        self.total_words = 0 #Number of words in full document collection
-        for doc_i in range(self.n_docs):
-            self.total_words += np.sum(self.doc_word_counts(doc_i))
-            self.total_sents += self.doc_len(doc_i)
+        self.total_sents = np.sum(self.doc_lens)
+        self.total_words = self.U_W_counts.sum() #Number of words in full document collection
+        self.wi_doc, self.wi_u = self.word_offset_table() #Document and sentence of each word of the collection
         self.seg_dur_prior_indv = docs.seg_dur_prior_indv
         self.seg_dur_prior_dataset = docs.seg_dur_prior_dataset
         self.seg_dur_prior_modality = docs.seg_dur_prior_modality
         
     def multi_doc_slicer(self, docs):
+        '''
+        Builds the offset table of the documents. Documents are not
+        copied, their word counts are read from the shared U_W_counts
+        matrix using the offset of their first sentence.
+        :param docs: MultiDocument object
+        '''
         doc_begin = 0
         for doc_end in docs.docs_index:
-            doc = copy.deepcopy(docs)
+            self.docs_begin.append(doc_begin)
             self.doc_lens.append(doc_end - doc_begin)
-            U_W_counts = doc.U_W_counts[doc_begin:doc_end, :]
-            self.docs_word_counts.append(U_W_counts)
             doc_begin = doc_end
+            
+    def word_offset_table(self):
+        '''
+        Returns the arrays with the document and the sentence (position in
+        d_u_wi_indexes) of each word index of the full collection.
+        '''
+        wi_doc = np.full(len(self.W_I_words), -1, dtype=np.int32)
+        wi_u = np.full(len(self.W_I_words), -1, dtype=np.int32)
+        for doc_i, doc_u_wi_indexes in enumerate(self.d_u_wi_indexes):
+            for u, wi_indexes in enumerate(doc_u_wi_indexes):
+                wi_doc[wi_indexes] = doc_i
+                wi_u[wi_indexes] = u
+        return wi_doc, wi_u
+        
+    def rho_slicer(self, docs):
+        '''
+        Returns the gold standard segmentation of each document.
+        The last sentence of each document is not a segment break.
+        :param docs: MultiDocument object
+        '''
+        docs_rho = []
+        doc_begin = 0
+        for doc_end in docs.docs_index:
+            doc_rho = np.array(docs.rho[doc_begin:doc_end])
+            doc_rho[-1] = 0
+            docs_rho.append(doc_rho)
+            doc_begin = doc_end
+        return docs_rho
         
     def doc_len(self, doc_i):
         '''
@@ -578,14 +828,55 @@ class Data(object):
         
     def doc_word_counts(self, doc_i):
         '''
-        Returns the word count matrix for doc_i
+        Returns the word count matrix (CSR format) for doc_i
         :param doc_i: document index
         '''
-        return self.docs_word_counts[doc_i]
+        doc_begin = self.docs_begin[doc_i]
+        return self.U_W_counts[doc_begin:doc_begin+self.doc_lens[doc_i]]
     
-    def all_doc_word_counts(self):
-        return self.doc_synth.U_W_counts
+    def seg_sparse_word_counts(self, doc_i, u_begin, u_end):
+        '''
+        Returns the vocabulary indexes of the words in the sentences u_begin
+        to u_end (inclusive) of doc_i and the corresponding counts.
+        :param doc_i: document index
+        '''
+        doc_begin = self.docs_begin[doc_i]
+        begin = self.U_W_counts.indptr[doc_begin+u_begin]
+        end = self.U_W_counts.indptr[doc_begin+u_end+1]
+        w_indexes = self.U_W_counts.indices[begin:end]
+        w_counts = self.U_W_counts.data[begin:end]
+        if u_end > u_begin: #The same word can appear in several sentences
+            w_indexes, w_pos = np.unique(w_indexes, return_inverse=True)
+            w_counts = np.bincount(w_pos, weights=w_counts).astype(np.int64)
+        return w_indexes, w_counts
     
+    def all_doc_word_counts(self):
+        return self.U_W_counts
+
+    def dump_word_counts(self, counts_dir):
+        '''
+        Writes the CSR arrays of U_W_counts to counts_dir so that
+        other processes can map them with load_word_counts.
+        :param counts_dir: directory where the arrays are saved
+        '''
+        for name in ["data", "indices", "indptr"]:
+            np.save(os.path.join(counts_dir, name+".npy"), getattr(self.U_W_counts, name))
+        return self.U_W_counts.shape
+
+    def load_word_counts(self, counts_dir, shape):
+        '''
+        Sets U_W_counts to a CSR matrix backed by the (read-only) memory
+        mapped arrays written by dump_word_counts. The pages are shared
+        between all the processes mapping the same files.
+        :param counts_dir: directory where the arrays were saved
+        :param shape: shape of the U_W_counts matrix
+        '''
+        data, indices, indptr = [np.load(os.path.join(counts_dir, name+".npy"), mmap_mode="r") for name in ["data", "indices", "indptr"]]
+        self.U_W_counts = sparse.csr_matrix(shape, dtype=data.dtype)
+        self.U_W_counts.data = data
+        self.U_W_counts.indices = indices
+        self.U_W_counts.indptr = indptr
+
     def get_doc_i(self, u):
         for doc_i, doc_i_index in enumerate(self.docs_index):
             if u < doc_i_index:
@@ -636,20 +927,202 @@ class Data(object):
                     u_k_cluster.add_sents(doc_u, doc_u, doc_i)
         return gs_u_clusters
     
+class SegmentationState(list):
+    '''
+    List of SentenceCluster corresponding to a segmentation that also keeps
+    the position of the cluster of each topic k and, for each document, the
+    topics of its segments ordered by their position in the document.
+    Also keeps the number of sentences of each document (with the number of
+    segments, the sufficient statistics of the duration priors) and caches
+    the log prior of the segmentation.
+    The indexes are only kept updated by append, pop and item assignment,
+    and clusters must not be modified while in the list (they are replaced
+    by a modified copy instead, see assign_target_k).
+    '''
+    __slots__ = ("k_index", "doc_index", "doc_n_sents", "log_prior")
+    
+    def __init__(self, u_clusters=()):
+        list.__init__(self, u_clusters)
+        self.k_index = {}
+        self.doc_index = {}
+        self.doc_n_sents = {}
+        self.log_prior = None
+        for i, u_cluster in enumerate(self):
+            self.k_index[u_cluster.k] = i
+            self.index_docs(u_cluster)
+            
+    def __copy__(self):
+        state = SegmentationState.__new__(SegmentationState)
+        list.extend(state, self)
+        state.k_index = dict(self.k_index)
+        state.doc_index = {doc_i: list(k_list) for doc_i, k_list in self.doc_index.items()}
+        state.doc_n_sents = dict(self.doc_n_sents)
+        state.log_prior = self.log_prior
+        return state
+    
+    def __reduce__(self):
+        #The indexes are rebuilt when unpickling (e.g., deepcopy)
+        return (SegmentationState, (list(self),))
+    
+    def index_docs(self, u_cluster):
+        self.log_prior = None
+        for doc_i in u_cluster.get_docs():
+            u_begin, u_end = u_cluster.get_segment(doc_i)
+            self.doc_n_sents[doc_i] = self.doc_n_sents.get(doc_i, 0)+u_end-u_begin+1
+            k_list = self.doc_index.setdefault(doc_i, [])
+            j = len(k_list)
+            while j > 0 and self.get_k_cluster(k_list[j-1]).get_segment(doc_i)[0] > u_begin:
+                j -= 1
+            k_list.insert(j, u_cluster.k)
+            
+    def unindex_docs(self, u_cluster):
+        self.log_prior = None
+        for doc_i in u_cluster.get_docs():
+            u_begin, u_end = u_cluster.get_segment(doc_i)
+            self.doc_n_sents[doc_i] -= u_end-u_begin+1
+            self.doc_index[doc_i].remove(u_cluster.k)
+    
+    def __setitem__(self, i, u_cluster):
+        prev_u_cluster = self[i]
+        self.unindex_docs(prev_u_cluster)
+        list.__setitem__(self, i, u_cluster)
+        self.k_index.pop(prev_u_cluster.k)
+        self.k_index[u_cluster.k] = i
+        self.index_docs(u_cluster)
+        
+    def append(self, u_cluster):
+        list.append(self, u_cluster)
+        self.k_index[u_cluster.k] = len(self)-1
+        self.index_docs(u_cluster)
+        
+    def pop(self, i=-1):
+        u_cluster = list.pop(self, i)
+        self.k_index.pop(u_cluster.k)
+        for j in range(i % (len(self)+1), len(self)):
+            self.k_index[self[j].k] = j
+        self.unindex_docs(u_cluster)
+        return u_cluster
+    
+    def get_k_cluster_index(self, k):
+        return self.k_index.get(k)
+    
+    def get_k_cluster(self, k):
+        i = self.k_index.get(k)
+        return None if i is None else self[i]
+    
+    def get_cluster_order(self, doc_i):
+        return list(self.doc_index.get(doc_i, []))
+    
+    def encode(self, n_docs):
+        '''
+        Returns a compact representation of the segmentation with small integer
+        arrays: for each document, the last sentence of each of its segments and
+        their topics, plus the topic and log likelihood of each cluster (in list order)
+        and the cached log prior. Used to send beam entries to the greedy workers.
+        Segments of a document are assumed to be contiguous and to start at sentence 0.
+        :param n_docs: number of documents
+        '''
+        doc_ends = []
+        doc_topics = []
+        for doc_i in range(n_docs):
+            k_list = self.doc_index.get(doc_i, [])
+            doc_ends.append(np.array([self.get_k_cluster(k).get_segment(doc_i)[1] for k in k_list], dtype=np.int32))
+            doc_topics.append(np.array(k_list, dtype=np.int32))
+        ks = np.array([u_cluster.k for u_cluster in self], dtype=np.int32)
+        cluster_lls = np.array([np.nan if u_cluster.get_cluster_ll() is None else u_cluster.get_cluster_ll() for u_cluster in self])
+        return doc_ends, doc_topics, ks, cluster_lls, self.log_prior
+    
+    @staticmethod
+    def decode(encoded_seg):
+        '''
+        Returns the SegmentationState of a segmentation encoded by encode.
+        The word counts of the clusters are computed when needed.
+        '''
+        doc_ends, doc_topics, ks, cluster_lls, log_prior = encoded_seg
+        k_clusters = {}
+        for doc_i in range(len(doc_ends)):
+            u_begin = 0
+            for u_end, k in zip(doc_ends[doc_i].tolist(), doc_topics[doc_i].tolist()):
+                if k in k_clusters:
+                    k_clusters[k].add_sents(u_begin, u_end, doc_i)
+                else:
+                    k_clusters[k] = SentenceCluster(u_begin, u_end, [doc_i], k)
+                u_begin = u_end+1
+        
+        u_clusters = []
+        for k, cluster_ll in zip(ks.tolist(), cluster_lls.tolist()):
+            u_cluster = k_clusters[k]
+            if not np.isnan(cluster_ll):
+                u_cluster.set_cluster_ll(cluster_ll)
+            u_clusters.append(u_cluster)
+        state = SegmentationState(u_clusters)
+        state.log_prior = log_prior
+        return state
+    
+class TopicTrackingChain(object):
+    '''
+    Topic tracking parameters of a segmentation, cluster by cluster.
+    Position t has the cluster, its alpha, its log likelihood and the phi
+    estimated from it (phi[0] is the initial phi, thus, phi[t] is the prior
+    of cluster t). keys[t+1] identifies the contents of the clusters up to t,
+    it is the tuple (keys[t], signature of cluster t) and keys[0] = () stands
+    for the empty chain. Prefixes are shared between
+    the chains of different segmentations, the arrays are never modified.
+    '''
+    __slots__ = ("u_clusters", "alpha", "phi", "cluster_lls", "keys")
+    
+    def __init__(self, phi_t0):
+        self.u_clusters = []
+        self.alpha = []
+        self.phi = [phi_t0]
+        self.cluster_lls = []
+        self.keys = [()]
+        
+    def common_prefix_len(self, u_clusters):
+        '''
+        Returns the number of leading clusters of u_clusters that are the
+        same objects as the ones in this chain.
+        '''
+        t = 0
+        for u_cluster, chain_u_cluster in zip(u_clusters, self.u_clusters):
+            if u_cluster is not chain_u_cluster:
+                break
+            t += 1
+        return t
+    
+    def prefix(self, t):
+        '''
+        Returns a new chain with the first t positions of this one.
+        '''
+        tt_chain = TopicTrackingChain(self.phi[0])
+        tt_chain.u_clusters = self.u_clusters[:t]
+        tt_chain.alpha = self.alpha[:t]
+        tt_chain.phi = self.phi[:t+1]
+        tt_chain.cluster_lls = self.cluster_lls[:t]
+        tt_chain.keys = self.keys[:t+1]
+        return tt_chain
+    
+    def append(self, u_cluster, alpha_t, phi_t, cluster_ll, key):
+        self.u_clusters.append(u_cluster)
+        self.alpha.append(alpha_t)
+        self.phi.append(phi_t)
+        self.cluster_lls.append(cluster_ll)
+        self.keys.append(key)
+        
 class SentenceCluster(object):
     '''
     Class to keep track of a set of sentences (possibly from different documents)
     that belong to the same segment.
     '''
-    def __init__(self, u_begin, u_end, docs, k, track_words=False):
+    __slots__ = ("k", "doc_segs_dict", "word_counts", "n_words", "cluster_ll")
+    
+    def __init__(self, u_begin, u_end, docs, k):
         self.k = k
         self.doc_segs_dict = {}
         global GL_DATA
-        #self.word_counts = np.zeros(GL_DATA.W)
-        self.track_words = track_words
+        self.word_counts = None #Computed on demand, afterwards kept updated by add_sents/remove_doc/remove_seg
+        self.n_words = None
         self.cluster_ll = None
-        self.phi_tt = None
-        self.alpha_tt = None
         
         for doc_i in docs:
             doc_i_len = GL_DATA.doc_len(doc_i)
@@ -662,29 +1135,32 @@ class SentenceCluster(object):
             else:
                 u_end_true = u_end
             self.doc_segs_dict[doc_i] = [u_begin, u_end_true]
-            
-            #self.word_counts += np.sum(GL_DATA.doc_word_counts(doc_i)[u_begin:u_end_true+1], axis=0)
-        
-        self.wi_list = []
-        for doc_i in docs:
-            doc_i_len = GL_DATA.doc_len(doc_i)
-            #Accounting for documents with different lengths
-            if u_begin > doc_i_len-1:
-                continue
-            if u_end > doc_i_len-1:
-                true_u_end = doc_i_len-1
-            else:
-                true_u_end = u_end
-            if self.track_words:
-                for u in range(u_begin, true_u_end+1):
-                    d_u_words = GL_DATA.d_u_wi_indexes[doc_i][u]
-                    self.wi_list += d_u_words
                     
+    def copy(self):
+        '''
+        Returns a copy of the cluster that can be modified without changing
+        this one. The word counts and log likelihood are not copied,
+        the copy keeps referencing them until it is modified (updates
+        always create new arrays).
+        '''
+        u_cluster = SentenceCluster.__new__(SentenceCluster)
+        u_cluster.k = self.k
+        u_cluster.doc_segs_dict = {doc_i: list(seg) for doc_i, seg in self.doc_segs_dict.items()}
+        u_cluster.word_counts = self.word_counts
+        u_cluster.n_words = self.n_words
+        u_cluster.cluster_ll = self.cluster_ll
+        return u_cluster
+    
     def set_k(self, k):
         self.k = k
         
     def has_word(self, wi):
-        return wi in self.wi_list
+        '''
+        Returns True if the segment of the document of word wi includes its sentence.
+        :param wi: index of the word. This index is relative to full document collection
+        '''
+        seg = self.doc_segs_dict.get(GL_DATA.wi_doc[wi])
+        return seg is not None and seg[0] <= GL_DATA.wi_u[wi] <= seg[1]
         
     def has_doc(self, doc_i):
         return doc_i in self.doc_segs_dict.keys()
@@ -699,29 +1175,21 @@ class SentenceCluster(object):
             u_end = doc_i_len-1
             
         if self.has_doc(doc_i):
-            current_u_begin, current_u_end = self.get_segment(doc_i)
-            if u_begin < current_u_begin:
-                current_u_begin = u_begin
-            if u_end > current_u_end:
-                current_u_end = u_end
+            prev_u_begin, prev_u_end = self.get_segment(doc_i)
+            current_u_begin = min(u_begin, prev_u_begin)
+            current_u_end = max(u_end, prev_u_end)
             self.doc_segs_dict[doc_i] = [current_u_begin, current_u_end]
+            if current_u_begin < prev_u_begin:
+                self.update_word_counts(doc_i, current_u_begin, prev_u_begin-1, 1)
+            if current_u_end > prev_u_end:
+                self.update_word_counts(doc_i, prev_u_end+1, current_u_end, 1)
         else:
             self.doc_segs_dict[doc_i] = [u_begin, u_end]
+            self.update_word_counts(doc_i, u_begin, u_end, 1)
             
-        seg = list(range(u_begin, u_end+1))
-        #self.word_counts += np.sum(GL_DATA.doc_word_counts(doc_i)[u_begin:u_end+1], axis=0)
-        
-        if self.track_words:
-            for u in seg:
-                d_u_words = GL_DATA.d_u_wi_indexes[doc_i][u]
-                self.wi_list += d_u_words                                                           
-            
-    def remove_doc(self, doc_i, doc_i_word_counts):
-        #self.word_counts -= doc_i_word_counts
-        if self.track_words:
-            for doc_w_i in self.get_doc_words(doc_i):
-                self.wi_list.remove(doc_w_i)
-            
+    def remove_doc(self, doc_i):
+        u_begin, u_end = self.get_segment(doc_i)
+        self.update_word_counts(doc_i, u_begin, u_end, -1)
         self.doc_segs_dict.pop(doc_i)
         
     def remove_seg(self, doc_i, u_begin, u):
@@ -734,39 +1202,52 @@ class SentenceCluster(object):
             else:
                 self.doc_segs_dict[doc_i] = [current_seg[0], u_begin-1]
             
-        #self.word_counts -= np.sum(GL_DATA.doc_word_counts(doc_i)[u_begin:u+1], axis=0)
-        seg = list(range(u_begin, u+1))
-        for u in seg:
-            d_u_words = GL_DATA.d_u_wi_indexes[doc_i][u]
-            if self.track_words:
-                for doc_w_i in d_u_words:
-                    self.wi_list.remove(doc_w_i)
+        self.update_word_counts(doc_i, u_begin, u, -1)
             
     def get_docs(self):
         return self.doc_segs_dict.keys()
+    
+    def get_signature(self):
+        '''
+        Returns a canonical representation of the cluster contents
+        (its segments sorted by document), which can be used as a dictionary key.
+        '''
+        return tuple(sorted((doc_i, seg[0], seg[1]) for doc_i, seg in self.doc_segs_dict.items()))
         
     def get_word_counts(self):
         '''
-        word_counts = np.zeros(GL_DATA.W)
-        for doc_i in self.get_docs():
-            u_begin, u_end = self.get_segment(doc_i)
-            word_counts += np.sum(GL_DATA.doc_word_counts(doc_i)[u_begin:u_end+1], axis=0)
-        return word_counts
+        Returns the word counts of all sentences in the cluster. Note that
+        the cached vector is never modified in place (the updates create
+        a new array), thus, callers must not modify it either.
         '''
-        u_indexes = []
-        for doc_i in self.get_docs():
-            if doc_i > 0:
-                doc_carry = GL_DATA.docs_index[doc_i-1]
-            else:
-                doc_carry = 0
-            u_begin, u_end = self.get_segment(doc_i)
-            u_begin += doc_carry
-            u_end += doc_carry+1
-            u_indexes += list(range(u_begin, u_end))
-            
-        word_counts = np.sum(GL_DATA.doc_synth.U_W_counts[u_indexes], axis=0)
-        return word_counts
-        #return self.word_counts
+        if self.word_counts is None:
+            word_counts = np.zeros(GL_DATA.W, dtype=np.int64)
+            for doc_i in self.get_docs():
+                u_begin, u_end = self.get_segment(doc_i)
+                w_indexes, w_counts = GL_DATA.seg_sparse_word_counts(doc_i, u_begin, u_end)
+                word_counts[w_indexes] += w_counts
+            self.word_counts = word_counts
+            self.n_words = word_counts.sum()
+        return self.word_counts
+    
+    def get_n_words(self):
+        if self.n_words is None:
+            self.get_word_counts()
+        return self.n_words
+    
+    def update_word_counts(self, doc_i, u_begin, u_end, sign):
+        '''
+        Adds (sign=1) or subtracts (sign=-1) the word counts of the sentences
+        u_begin to u_end of doc_i. Only the nonzero entries of these sentences
+        are touched. Nothing to do if the word counts were not computed yet.
+        '''
+        if self.word_counts is None:
+            return
+        w_indexes, w_counts = GL_DATA.seg_sparse_word_counts(doc_i, u_begin, u_end)
+        word_counts = self.word_counts.copy()
+        word_counts[w_indexes] += sign*w_counts
+        self.word_counts = word_counts
+        self.n_words += sign*w_counts.sum()
     
     def get_cluster_ll(self):
         return self.cluster_ll
@@ -774,20 +1255,15 @@ class SentenceCluster(object):
     def set_cluster_ll(self, ll):
         self.cluster_ll = ll
         
-    def get_alpha_tt(self):
-        return self.alpha_tt
-    
-    def set_alpha_tt(self, alpha_tt):
-        self.alpha_tt = alpha_tt
-        
-    def get_phi_tt(self):
-        return self.phi_tt
-    
-    def set_phi_tt(self, phi_tt):
-        self.phi_tt = phi_tt
-        
     def get_words(self):
-        return self.wi_list
+        '''
+        Returns the indexes of the words in the cluster, obtained from
+        the segments of each document (words are not stored).
+        '''
+        wi_list = []
+        for doc_i in self.doc_segs_dict:
+            wi_list += self.get_doc_words(doc_i)
+        return wi_list
     
     def get_doc_words(self, doc_i):
         wi_list = []
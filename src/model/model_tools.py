@@ -4,15 +4,162 @@ Created on Feb 9, 2017
 @author: root
 '''
 from scipy.special import gammaln
+import numpy as np
+import collections
+import operator
+import heapq
 import time
 
-gammaln_cache_dic = {}
+class LRUCache(object):
+    '''
+    Dictionary with a maximum number of entries. When full, the least
+    recently used entry is discarded. Keeps track of the number of
+    hits and misses of get.
+    '''
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        
+    def get(self, key):
+        '''
+        Returns the value of key or None if key is not in the cache.
+        '''
+        value = self.cache.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return value
+    
+    def put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+            
+    def clear(self):
+        self.cache.clear()
+        
+    def __len__(self):
+        return len(self.cache)
+    
+    def __str__(self):
+        return "size: %d hits: %d misses: %d" % (len(self.cache), self.hits, self.misses)
+
+class Beam(object):
+    '''
+    Keeps the max_size entries with the highest log likelihood (the first
+    element of an entry, e.g. (seg_ll, u_clusters, ...)) out of all pushed
+    entries using a bounded min-heap. Kept entries have different dedup keys
+    (by default the log likelihood, e.g. a structural signature of a segmentation):
+    of two equivalent entries only the one with the highest log likelihood is kept.
+    Ties are broken in favour of the entries pushed first.
+    '''
+    def __init__(self, max_size, dedup_key=operator.itemgetter(0), kept_keys=None):
+        self.max_size = max_size
+        self.dedup_key = dedup_key
+        self.kept_keys = {} if kept_keys is None else kept_keys #dedup key -> (beam, heap item)
+        self.heap = [] #Items are (log likelihood, -push order, dedup key, entry)
+        self.n_pushed = 0
+        
+    def remove(self, item):
+        self.heap.remove(item)
+        heapq.heapify(self.heap)
+        del self.kept_keys[item[2]]
+        
+    def push(self, entry):
+        '''
+        Returns True if entry was kept (it might still be pushed out later),
+        False if the beam is full of better entries and None if an equivalent
+        entry at least as likely is kept. The dedup key is only computed for
+        entries that fit in the beam.
+        '''
+        if self.max_size <= 0 or (len(self.heap) == self.max_size and entry[0] <= self.heap[0][0]):
+            return False
+        key = self.dedup_key(entry)
+        if key in self.kept_keys:
+            beam, dup_item = self.kept_keys[key]
+            if entry[0] <= dup_item[0]:
+                return None
+            beam.remove(dup_item)
+        self.n_pushed += 1
+        item = (entry[0], -self.n_pushed, key, entry)
+        if len(self.heap) < self.max_size:
+            heapq.heappush(self.heap, item)
+        else:
+            del self.kept_keys[heapq.heapreplace(self.heap, item)[2]]
+        self.kept_keys[key] = (self, item)
+        return True
+    
+    def extend(self, entries):
+        for entry in entries:
+            self.push(entry)
+            
+    def best(self):
+        return max(self.heap, key=operator.itemgetter(0, 1))[3]
+    
+    def entries(self):
+        '''
+        Returns the kept entries sorted by decreasing log likelihood.
+        '''
+        return [item[3] for item in sorted(self.heap, key=operator.itemgetter(0, 1), reverse=True)]
+    
+    def __len__(self):
+        return len(self.heap)
+    
+class SlotBeam(object):
+    '''
+    Keeps the max_slot_size best entries of each slot (given by slot_key,
+    e.g. the topic of a segmentation candidate). Entries are deduplicated
+    across all slots (see Beam).
+    '''
+    def __init__(self, max_slot_size, slot_key, dedup_key=operator.itemgetter(0)):
+        self.max_slot_size = max_slot_size
+        self.slot_key = slot_key
+        self.dedup_key = dedup_key
+        self.kept_keys = {}
+        self.slots = {}
+        
+    def push(self, entry):
+        slot = self.slot_key(entry)
+        if slot not in self.slots:
+            self.slots[slot] = Beam(self.max_slot_size, self.dedup_key, self.kept_keys)
+        return self.slots[slot].push(entry)
+    
+    def extend(self, entries):
+        for entry in entries:
+            self.push(entry)
+            
+    def entries(self):
+        '''
+        Returns the kept entries of each slot sorted by decreasing log likelihood.
+        Slots are sorted by their best entry.
+        '''
+        slot_beams = [beam for beam in self.slots.values() if len(beam) > 0]
+        slot_beams = sorted(slot_beams, key=lambda beam: max(beam.heap, key=operator.itemgetter(0, 1))[:2], reverse=True)
+        entries = []
+        for beam in slot_beams:
+            entries += beam.entries()
+        return entries
+    
+def gammaln_table(max_n, offset):
+    '''
+    Returns the table of gammaln(n+offset) for n in 0..max_n. If offset
+    is an array the table has one row for each of its values.
+    :param max_n: largest integer argument of the table
+    :param offset: constant added to the integer arguments
+    '''
+    return gammaln(np.arange(max_n+1)+np.asarray(offset, dtype=np.float64)[..., None])
+
+gammaln_cache_dic = LRUCache()
 def gammaln_cache(x):
-    if x not in gammaln_cache_dic:
+    val = gammaln_cache_dic.get(x)
+    if val is None:
         val = gammaln(x)
-        gammaln_cache_dic[x] = val
-    else:
-        val = gammaln_cache_dic[x]
+        gammaln_cache_dic.put(x, val)
     return val
 
 def cache_gammaln_mat_sum(M):
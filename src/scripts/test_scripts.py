@@ -36,8 +36,8 @@ import re
 def hyper_param_opt(data, n=10):
     dir_samples = []
     alpha = 0.01
-    for i in range(0, len(data.U_W_counts), n):
-        word_counts = np.sum(data.U_W_counts[i:i+n], axis=0)
+    for i in range(0, data.U_W_counts.shape[0], n):
+        word_counts = np.asarray(data.U_W_counts[i:i+n].sum(axis=0)).ravel()
         total_words = np.sum(word_counts)
         dir_samples.append((word_counts+alpha)/(total_words+alpha*data.W))
     dir_samples = np.array(dir_samples)
@@ -51,8 +51,8 @@ def hyper_param_opt_v2(doc_col):
     alpha = 0.01
     for doc_i, doc in enumerate(single_docs):
         n = int(doc_col.seg_dur_prior[doc_i][0])
-        for i in range(0, len(doc.U_W_counts), n):
-            word_counts = np.sum(doc.U_W_counts[i:i+n], axis=0)
+        for i in range(0, doc.U_W_counts.shape[0], n):
+            word_counts = np.asarray(doc.U_W_counts[i:i+n].sum(axis=0)).ravel()
             total_words = np.sum(word_counts)
             dir_samples.append((word_counts+alpha)/(total_words+alpha*doc_col.W))
     dir_samples = np.array(dir_samples)
@@ -65,9 +65,9 @@ def get_best_prior(data):
     flat_gs_topics = list(chain(*flat_gs_topics))
     for u, k in enumerate(flat_gs_topics):
         if k in topic_draws:
-            topic_draws[k] += data.U_W_counts[u]
+            topic_draws[k] += data.U_W_counts[u].toarray().ravel()
         else:
-            topic_draws[k] = data.U_W_counts[u]
+            topic_draws[k] = data.U_W_counts[u].toarray().ravel()
     
     dir_samples = []
     alpha = 0.01
@@ -184,11 +184,11 @@ def eval_pipeline_linking(seg_results_dir, configs_dir):
         for k in hyp_topic_seqs:
             if k_prev != k:
                 seg_lens.append(end-start)
-                clustering_points.append(np.sum(doc_col.U_W_counts[start:end], axis=0))
+                clustering_points.append(np.asarray(doc_col.U_W_counts[start:end].sum(axis=0)).ravel())
                 start = end
                 k_prev = k
             end += 1
-        clustering_points.append(np.sum(doc_col.U_W_counts[start:end], axis=0))
+        clustering_points.append(np.asarray(doc_col.U_W_counts[start:end].sum(axis=0)).ravel())
         seg_lens.append(end-start)
         if num_clusters >= len(seg_lens):
             num_clusters = len(seg_lens)-3
@@ -754,9 +754,6 @@ def real_dataset_tests(data_config, greedy_seg_config):
                          "alpha_tt_t0": 4,\
                          "phi_log_dir": "../logs/phi"}
     all_configs = get_all_greedy_configs(greedy_seg_config)
-    if greedy_seg_config["run_parallel"]:
-        import ray
-        ray.init(redirect_output=True)
     #single_docs = doc_col.get_single_docs()
     models = []
     models_names = []
@@ -0,0 +1,56 @@
+'''
+Shared fixtures of the segmentor tests.
+'''
+import os
+import sys
+import numpy as np
+import pytest
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from model.dp.segmentor import Data, SEG_BL
+
+class ToyDocs(object):
+    '''
+    Minimal MultiDocument-like collection built from lists of sentences
+    (each sentence is a list of vocabulary indexes).
+    '''
+    def __init__(self, docs_sents, W, docs_rho_topics):
+        self.n_docs = len(docs_sents)
+        self.W = W
+        self.doc_names = ["doc%d.txt" % doc_i for doc_i in range(self.n_docs)]
+        self.doc_rho_topics = docs_rho_topics
+        self.docs_index = list(np.cumsum([len(sents) for sents in docs_sents]))
+        self.U_W_counts = np.zeros((self.docs_index[-1], W), dtype=np.int64)
+        self.W_I_words = []
+        self.d_u_wi_indexes = []
+        self.rho = []
+        u_gl = 0
+        for sents, rho_topics in zip(docs_sents, docs_rho_topics):
+            u_wi_indexes = []
+            for u, sent in enumerate(sents):
+                u_wi_indexes.append(list(range(len(self.W_I_words), len(self.W_I_words)+len(sent))))
+                self.W_I_words += sent
+                for w in sent:
+                    self.U_W_counts[u_gl, w] += 1
+                is_last = u == len(sents)-1 or rho_topics[u] != rho_topics[u+1]
+                self.rho.append(1 if is_last else 0)
+                u_gl += 1
+            self.d_u_wi_indexes.append(u_wi_indexes)
+        self.W_I_words = np.array(self.W_I_words)
+        self.seg_dur_prior_indv = [[2.0, 1.0]]*self.n_docs
+        self.seg_dur_prior_dataset = [[2.0, 1.0]]*self.n_docs
+        self.seg_dur_prior_modality = [[2.0, 1.0]]*self.n_docs
+
+@pytest.fixture
+def toy_data():
+    docs_sents = [[[0, 1, 1], [0, 2], [3, 4, 4], [4, 5]],
+                  [[1, 0], [2, 2, 0], [5, 3], [3, 4]]]
+    docs_rho_topics = [[0, 0, 1, 1], [0, 0, 1, 1]]
+    return Data(ToyDocs(docs_sents, 6, docs_rho_topics))
+
+@pytest.fixture
+def bl_config(tmp_path):
+    return {"beta": np.array([0.1]*6), "use_dur_prior": False, "max_topics": 3,
+            "seg_func": SEG_BL, "fast_digamma": True, "max_cache": 10,
+            "phi_log_dir": str(tmp_path/"phi"), "run_parallel": False,
+            "check_cache_flag": False, "log_flag": False, "flush_cache_flag": False,
+            "slack_flag": False, "topic_slack": 0, "max_seg_len": 1000}
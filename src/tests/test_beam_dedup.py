@@ -0,0 +1,39 @@
+import numpy as np
+from model.dp.multi_doc_greedy_segmentor import MultiDocGreedySeg
+from model.dp.segmentor import SegmentationState, SentenceCluster
+
+def make_seg(seg_ll, labels, last_k):
+    '''
+    Builds a materialized candidate with doc 0 split in two segments
+    (sentences 0-1 and 2-3) with the topics in labels.
+    '''
+    u_clusters = SegmentationState([SentenceCluster(0, 1, [0], labels[0]),\
+                                    SentenceCluster(2, 3, [0], labels[1])])
+    return (seg_ll, u_clusters, None, last_k)
+
+def test_prune_relabeled_candidates(toy_data, bl_config):
+    bl_config["max_topics"] = 2
+    bl_config["max_cache"] = 4
+    seg_model = MultiDocGreedySeg(toy_data, seg_config=bl_config)
+    seg_ll = -100.0
+    seg_a = make_seg(seg_ll, [0, 1], 1)
+    #Same segmentation with the topic labels swapped, its likelihood only differs by rounding errors
+    seg_b = make_seg(np.nextafter(seg_ll, -np.inf), [1, 0], 0)
+    assert seg_model.get_seg_result_signature(seg_a, 0, 3) == seg_model.get_seg_result_signature(seg_b, 0, 3)
+    
+    for cache_prune in [seg_model.topn_cache_prune, seg_model.k_slot_cache_prune]:
+        for doc_i_segs in [[seg_a, seg_b], [seg_b, seg_a]]:
+            cached_segs = cache_prune(doc_i_segs, 0, 3)
+            assert len(cached_segs) == 1
+            assert cached_segs[0] is seg_a
+
+def test_prune_keeps_distinct_candidates(toy_data, bl_config):
+    bl_config["max_topics"] = 2
+    bl_config["max_cache"] = 4
+    seg_model = MultiDocGreedySeg(toy_data, seg_config=bl_config)
+    seg_a = make_seg(-100.0, [0, 1], 1)
+    #Different segmentation (a single topic) with exactly the same likelihood
+    seg_b = (-100.0, SegmentationState([SentenceCluster(0, 3, [0], 0)]), None, 0)
+    for cache_prune in [seg_model.topn_cache_prune, seg_model.k_slot_cache_prune]:
+        cached_segs = cache_prune([seg_a, seg_b], 0, 3)
+        assert len(cached_segs) == 2
@@ -0,0 +1,20 @@
+import numpy as np
+import model.dp.multi_doc_vi_segmentor as vi_seg
+
+def test_vi_segmentation_step_word_membership(toy_data, bl_config, tmp_path):
+    np.random.seed(1)
+    bl_config["type"] = vi_seg.VI_SEG
+    vi_model = vi_seg.MultiDocVISeg(toy_data, seg_config=bl_config, log_dir=str(tmp_path)+"/")
+    vi_model.set_gl_data(toy_data)
+    vi_model.vi_segmentation_step()
+    seg_ll, u_clusters = vi_model.best_segmentation[-1][0]
+    assert np.isfinite(seg_ll)
+    
+    for wi in range(toy_data.total_words):
+        u_cluster = vi_model.get_wi_segment(wi, u_clusters)
+        assert u_cluster is not None
+        assert wi in u_cluster.get_words()
+        assert sum(u_cluster.has_word(wi) for u_cluster in u_clusters) == 1
+        #Words of the same cluster (minus wi) used in the variational update of wi
+        words = vi_model.qz_words_minus_wi_gibbs(None, toy_data.wi_doc[wi], toy_data.wi_u[wi], wi, u_cluster.k, u_clusters)
+        assert sorted(words) == sorted(set(u_cluster.get_words())-set([wi]))
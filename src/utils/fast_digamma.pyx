@@ -1,5 +1,5 @@
 #cython: boundscheck=False, wraparound=False, nonecheck=False
-from libc.math cimport exp 
+from libc.math cimport exp, lgamma
 import numpy as np
 
 cdef extern from "digamma_c.c":
@@ -17,4 +17,44 @@ def digamma_cython_np(double[:] X):
     return np.asarray(Y)
 
 def digamma_cython_d(double x):
-    return digamma(x)
\ No newline at end of file
+    return digamma(x)
+
+def topic_tracking_update_cython(const long long[:] w_indexes, const long long[:] w_counts, double n_words,\
+                                 const double[:] phi_t, double alpha_t, double[:] phi_t_update):
+    '''
+    Fused topic tracking update of a cluster. Computes the alpha update,
+    writes the phi update into phi_t_update and returns the updated alpha
+    and the cluster log likelihood. Only the nonzero counts of the cluster
+    (w_counts of the vocabulary entries w_indexes, which must be sorted) are
+    given, the digamma and lgamma terms of the remaining entries cancel exactly.
+    '''
+    cdef int W = phi_t.shape[0]
+    cdef int nnz = w_indexes.shape[0]
+    cdef int i, w
+    cdef double num_alpha_update = 0.0
+    cdef double alpha_phi
+    cdef double alpha_t_update
+    cdef double denom_phi_tt
+    cdef double cluster_ll
+    
+    for i in range(nnz):
+        w = w_indexes[i]
+        alpha_phi = alpha_t*phi_t[w]
+        num_alpha_update += phi_t[w]*(digamma(w_counts[i]+alpha_phi)-digamma(alpha_phi))
+    alpha_t_update = alpha_t*(num_alpha_update/(digamma(n_words+alpha_t)-digamma(alpha_t)))
+    
+    #Single pass over the vocabulary for the normalised phi update and the
+    #likelihood, w_indexes is sorted so the nonzero entries are met in order
+    denom_phi_tt = n_words+alpha_t_update
+    cluster_ll = lgamma(alpha_t_update)-lgamma(denom_phi_tt)
+    i = 0
+    for w in range(W):
+        alpha_phi = alpha_t_update*phi_t[w]
+        if i < nnz and w_indexes[i] == w:
+            phi_t_update[w] = (w_counts[i]+alpha_phi)/denom_phi_tt
+            cluster_ll += lgamma(w_counts[i]+alpha_phi)-lgamma(alpha_phi)
+            i += 1
+        else:
+            phi_t_update[w] = alpha_phi/denom_phi_tt
+            
+    return alpha_t_update, cluster_ll